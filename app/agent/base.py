@@ -2,13 +2,20 @@ from abc import ABC, abstractmethod
 from contextlib import asynccontextmanager
 from typing import List, Optional
 
-from pydantic import BaseModel, Field, model_validator
+from pydantic import BaseModel, Field, PrivateAttr, model_validator
 
+from app.config import config
 from app.llm import LLM, llm_embeddings
 from app.logger import logger
-from app.schema import ROLE_TYPE, AgentState, Memory, Message
+from app.memory import EmbeddingPipeline, format_episode
+from app.memory.pipeline import FLUSH_TIMEOUT
+from app.prompt.compaction import SUMMARY_PROMPT
+from app.schema import ROLE_TYPE, AgentState, Memory, MemoryShards, Message, memory_settings
 from time import time
 
+# compaction_llm names already reported as not configured
+_unconfigured_compaction_llms = set()
+
 
 class BaseAgent(BaseModel, ABC):
     """Abstract base class for managing agent state and execution.
@@ -32,6 +39,10 @@ class BaseAgent(BaseModel, ABC):
     # Dependencies
     llm: LLM = Field(default_factory=LLM, description="Language model instance")
     memory: Memory = Field(default_factory=Memory, description="Agent's memory store")
+    memory_shards: Optional[MemoryShards] = Field(
+        None, description="Per-session memories, `memory` follows the session set with `use_session`"
+    )
+    session: Optional[str] = Field(None, description="Current conversation, None for the agent's own memory")
     state: AgentState = Field(
         default=AgentState.IDLE, description="Current agent state"
     )
@@ -42,6 +53,11 @@ class BaseAgent(BaseModel, ABC):
 
     duplicate_threshold: int = 2
 
+    _embedder: Optional[EmbeddingPipeline] = PrivateAttr(default=None)
+    # sessions whose missing embeddings were queued since the process started
+    _backfilled: set = PrivateAttr(default_factory=set)
+    _own_memory: Optional[Memory] = PrivateAttr(default=None)
+
     class Config:
         arbitrary_types_allowed = True
         extra = "allow"  # Allow extra fields for flexibility in subclasses
@@ -84,21 +100,143 @@ class BaseAgent(BaseModel, ABC):
         finally:
             self.state = previous_state  # Revert to previous state
 
+    def use_session(self, session: Optional[str]) -> None:
+        """Switch `memory` to the shard of a conversation, None switches back to the agent's own memory"""
+        if session is not None and self.memory_shards is None:
+            self.memory_shards = MemoryShards()
+        if self.session is None:
+            self._own_memory = self.memory
+        self.session = session
+        self.memory = self.session_memory(session)
+
+    def session_memory(self, session: Optional[str]) -> Memory:
+        if session is None:
+            return self._own_memory or self.memory
+        return self.memory_shards.get(session)
+
+    def _store_embedding(self, key: tuple, embeddings: bytes) -> None:
+        session, time = key
+        if session is None:
+            self.session_memory(None).set_embeddings(time, embeddings)
+        else:
+            self.memory_shards.set_embeddings(session, time, embeddings)
+
+    def _next_time(self) -> int:
+        """Millisecond timestamp, strictly after the newest message (time is the db key)"""
+        now = int(time()*1000)
+        if self.memory.messages:
+            now = max(now, self.memory.messages[-1].time + 1)
+        return now
+
+    @property
+    def embedder(self) -> EmbeddingPipeline:
+        """Background embedding of new messages, created on first use inside the event loop"""
+        if self._embedder is None:
+            settings = memory_settings()
+            self._embedder = EmbeddingPipeline(
+                llm_embeddings.get_embedding,
+                # keyed by (session, time), the session may have been switched or closed since
+                self._store_embedding,
+                workers=settings.embed_workers,
+                max_queue=settings.embed_queue_size,
+                batch_size=llm_embeddings.llm_config.embedding_batch_size,
+                retries=settings.embed_retries,
+            )
+        return self._embedder
+
     async def update_memory_message(
         self,
         msg: Message
     ):
-        msg.time = int(time()*1000)
-        if msg.content:
-            msg.embeddings = await llm_embeddings.get_embedding(msg.content)
+        """Add the message at once, its embedding is computed in the background"""
+        msg.time = self._next_time()
+        msg.tokens = self.llm.count_message(msg)
         self.memory.add_message(msg)
+        if msg.content and not msg.embeddings:
+            await self.embedder.submit((self.session, msg.time), msg.content)
+        await self._backfill_once()
 
     async def update_memory_messages(
         self,
         messages: List[Message]
     ):
+        start = self._next_time()
+        for i, msg in enumerate(messages):
+            msg.time = start + i
+            msg.tokens = self.llm.count_message(msg)
+        self.memory.add_messages(messages)
         for msg in messages:
-            await self.update_memory_message(msg)
+            if msg.content and not msg.embeddings:
+                await self.embedder.submit((self.session, msg.time), msg.content)
+        await self._backfill_once()
+
+    async def backfill_embeddings(self) -> int:
+        """Queue the stored messages of `memory` still without embedding, e.g. those whose
+        embedding failed or was still queued when the last run ended; returns how many"""
+        queued = 0
+        for time, content in self.memory.missing_embeddings(memory_settings().embed_queue_size):
+            key = (self.session, time)
+            if key not in self.embedder.pending:
+                await self.embedder.submit(key, content)
+                queued += 1
+        if queued:
+            logger.info(f"Queued {queued} messages stored without embedding")
+        return queued
+
+    async def _backfill_once(self) -> None:
+        """Backfill a session the first time this process writes to it"""
+        if self.session not in self._backfilled:
+            self._backfilled.add(self.session)
+            await self.backfill_embeddings()
+
+    async def wait_embedding(self, msg: Optional[Message]) -> None:
+        """Give a pending message embedding up to `embed_wait` seconds, e.g. before it is used as a query"""
+        if msg and not msg.embeddings and self._embedder is not None:
+            await self._embedder.wait((self.session, msg.time), memory_settings().embed_wait)
+
+    async def flush_memory(self, timeout: Optional[float] = FLUSH_TIMEOUT) -> bool:
+        """Wait for outstanding background embeddings, call before `close`"""
+        if self._embedder is None:
+            return True
+        # embeddings that failed since are given another try
+        await self.backfill_embeddings()
+        return await self._embedder.flush(timeout)
+
+    @staticmethod
+    def compaction_configured() -> bool:
+        """Whether `compaction_llm` names an [llm.<name>] section, compaction never falls back to the main model"""
+        name = memory_settings().compaction_llm
+        if name in config.llm:
+            return True
+        # the shipped default, reported once rather than by every agent
+        if name not in _unconfigured_compaction_llms:
+            _unconfigured_compaction_llms.add(name)
+            logger.info(f"Memory compaction disabled: no [llm.{name}] config for compaction_llm")
+        return False
+
+    async def compact_memory(self, memory: Optional[Memory] = None) -> int:
+        """Summarize the next old episodes of memory with the `compaction_llm` config, returns how many"""
+        if not self.compaction_configured():
+            return 0
+        memory = memory or self.memory
+        summarizer = LLM(config_name=memory_settings().compaction_llm)
+        done = 0
+        for episode in memory.episodes_to_compact():
+            transcript = format_episode(episode)
+            content = ""
+            if transcript:
+                content = await summarizer.ask(
+                    [Message.user_message(transcript)],
+                    system_msgs=[Message.system_message(SUMMARY_PROMPT)],
+                    stream=False,
+                )
+            embeddings = await llm_embeddings.get_embedding(content) if content else b""
+            summary = Message.assistant_message(content)
+            memory.add_summary(episode, content, embeddings, self.llm.count_message(summary))
+            done += 1
+        if done:
+            logger.info(f"Compacted {done} episodes into summaries")
+        return done
 
     async def update_memory(
         self,
@@ -148,6 +286,9 @@ class BaseAgent(BaseModel, ABC):
             raise RuntimeError(f"Cannot run agent from state: {self.state}")
 
         self.current_step = 0
+        if self.session is not None:
+            # the shard may have been closed by the LRU since the last run
+            self.memory = self.session_memory(self.session)
         if request and role == 'user':
             await self.update_memory(role, request)
 
@@ -216,5 +357,8 @@ class BaseAgent(BaseModel, ABC):
         self.memory.messages = value
 
     def close(self):
-        if self.memory:
-            self.memory.close()
+        if self.memory_shards is not None:
+            self.memory_shards.close()
+        memory = self.session_memory(None)
+        if memory:
+            memory.close()
@@ -9,12 +9,13 @@ from app.agent.react import ReActAgent
 from app.async_timer import AsyncTimer
 from app.logger import logger
 from app.prompt.toolcall import NEXT_STEP_PROMPT, SYSTEM_PROMPT
-from app.schema import AgentState, Message, ToolCall, ChatMessage
+from app.schema import AgentState, Message, ToolCall, ChatMessage, memory_settings
 from app.tool import CreateChatCompletion, Terminate, ToolCollection
 
 
 TOOL_CALL_REQUIRED = "Tool calls required but none provided"
 TIMER_ID_AGENT_ACTIVE = "agent_active"
+TIMER_ID_MEMORY_COMPACT = "memory_compact"
 JSON_MODE = False
 
 JSON_MODE_NEXT_PROMPT = """
@@ -57,6 +58,11 @@ class FullChatAgent(ReActAgent):
         if self.active_check:
             AsyncTimer.register_event(TIMER_ID_AGENT_ACTIVE, self.check_active)
             self.start_auto_active()
+        if memory_settings().compaction_interval > 0 and self.compaction_configured():
+            AsyncTimer.register_event(TIMER_ID_MEMORY_COMPACT, self.compact_check)
+            # a timer restored from the last run already keeps the chain going
+            if not AsyncTimer.pending(TIMER_ID_MEMORY_COMPACT):
+                self.start_auto_compact()
 
     async def step(self) -> str:
         """Execute a single step: think and act until exist response."""
@@ -73,21 +79,31 @@ class FullChatAgent(ReActAgent):
 
     async def think(self) -> bool:
         """Process current state and decide next actions using tools"""
-        context_messages = self.memory.get_context_messages(self.messages[-1] if len(self.messages) >= 1 else None, self.context_recent, self.context_related)
-        # Get response with tool options
+        self.drop_early_tools()
+        query = self.messages[-1] if len(self.messages) >= 1 else None
+        await self.wait_embedding(query)
+        system_msgs = [Message.system_message(self.system_prompt)] if self.system_prompt else None
+        next_msgs = []
         if self.next_step_prompt:
-            user_msg = Message.user_message(self.next_step_prompt +
-                                            JSON_MODE_NEXT_PROMPT if JSON_MODE else "" +
-                                            f"\n[SystemGenerated]#current time:{str(datetime.now())}" )
-            context_messages += [user_msg]
+            next_msgs = [Message.user_message(self.next_step_prompt +
+                                              JSON_MODE_NEXT_PROMPT if JSON_MODE else "" +
+                                              f"\n[SystemGenerated]#current time:{str(datetime.now())}" )]
+        tools = self.available_tools.to_params()
+        if memory_settings().context_budget:
+            budget = self.llm.context_budget((system_msgs or []) + next_msgs, tools)
+            context_messages = self.memory.get_budgeted_context(query, budget, self.llm)
+        else:
+            context_messages = self.memory.get_context_messages(query, self.context_recent, self.context_related)
+        # Get response with tool options
+        context_messages += next_msgs
         response = await self.llm.ask_tool(
             messages=context_messages,
-            system_msgs=[Message.system_message(self.system_prompt)]
-            if self.system_prompt
-            else None,
-            tools=self.available_tools.to_params(),
+            system_msgs=system_msgs,
+            tools=tools,
             tool_choice=self.tool_choices,
             response_format={"type": "json_object"} if JSON_MODE else None,
+            # a streamed response starts each tool call once its arguments are complete
+            on_tool_call=self.dispatch_tool if self.tool_choices != "none" else None,
         )
         logger.debug(response)
         if response.content:
@@ -160,7 +176,7 @@ class FullChatAgent(ReActAgent):
 
         results = []
         for command in self.tool_calls:
-            result = await self.execute_tool(command)
+            result = await self.tool_result(command)
             logger.debug(
                 f"🎯 Tool '{command.function.name}' completed its mission! Result: {result}"
             )
@@ -169,11 +185,15 @@ class FullChatAgent(ReActAgent):
             tool_msg = Message.tool_message(
                 content=result, tool_call_id=command.id, name=command.function.name
             )
+            # written as each tool finishes, so a tool writing memory itself stays in order
             await self.update_memory_message(tool_msg)
             results.append(result)
-
+        self.drop_early_tools()
         return "\n".join(results)
 
+    def can_dispatch_early(self, command: ToolCall) -> bool:
+        return self.available_tools.idempotent(command.function.name)
+
     async def execute_tool(self, command: ToolCall) -> str:
         """Execute a single tool call with robust error handling"""
         if not command or not command.function or not command.function.name:
@@ -249,6 +269,20 @@ the response message will be regarded as an active message request, if the time
         logger.debug(f"System active check:{interval}minutes")
         AsyncTimer.add_event(TIMER_ID_AGENT_ACTIVE, datetime.now().timestamp() + 60*interval)
 
+    async def compact_check(self):
+        memories = [self.session_memory(None)]
+        if self.memory_shards is not None:
+            memories += self.memory_shards.open_memories()
+        for memory in memories:
+            try:
+                await self.compact_memory(memory)
+            except Exception as e:
+                logger.error(f"Memory compaction failed: {e}")
+        self.start_auto_compact()
+
+    def start_auto_compact(self):
+        AsyncTimer.add_event(TIMER_ID_MEMORY_COMPACT, datetime.now().timestamp() + memory_settings().compaction_interval)
+
     @staticmethod
     def _should_finish_execution(**kwargs) -> bool:
         """Determine if tool execution should finish the agent"""
@@ -1,11 +1,13 @@
+import asyncio
 from abc import ABC, abstractmethod
-from typing import Optional
+from typing import Any, Dict, Optional
 
-from pydantic import Field
+from pydantic import Field, PrivateAttr
 
 from app.agent.base import BaseAgent
 from app.llm import LLM
-from app.schema import AgentState, Memory
+from app.logger import logger
+from app.schema import AgentState, Memory, ToolCall
 
 
 class ReActAgent(BaseAgent, ABC):
@@ -22,6 +24,10 @@ class ReActAgent(BaseAgent, ABC):
     max_steps: int = 10
     current_step: int = 0
 
+    # tool calls started while the response was still streaming, by call id
+    _early_tools: Dict[str, asyncio.Task] = PrivateAttr(default_factory=dict)
+    _last_early_tool: Optional[asyncio.Task] = PrivateAttr(default=None)
+
     @abstractmethod
     async def think(self) -> bool:
         """Process current state and decide next action"""
@@ -30,6 +36,50 @@ class ReActAgent(BaseAgent, ABC):
     async def act(self) -> str:
         """Execute decided actions"""
 
+    async def run_tool(self, command: ToolCall) -> Any:
+        """Execute one tool call for `act`, subclasses with tools implement `execute_tool`"""
+        return await self.execute_tool(command)
+
+    def can_dispatch_early(self, command: ToolCall) -> bool:
+        """Whether a call may start before its response is complete and recorded, only idempotent tools"""
+        return False
+
+    def dispatch_tool(self, command: ToolCall) -> Optional[asyncio.Task]:
+        """Start a tool call whose arguments finished streaming (`on_tool_call` of `LLM.ask_tool`).
+
+        Calls still run one after another in the order they were made, only
+        overlapped with the generation of the rest of the message. Only calls
+        of idempotent tools start early, the rest run in `act` once the
+        assistant message is in memory. The task is returned so a failed
+        streaming attempt can cancel it before the request is retried.
+        """
+        if not self.can_dispatch_early(command):
+            return None
+        previous = self._last_early_tool
+
+        async def run():
+            if previous is not None:
+                await asyncio.wait([previous])
+            return await self.run_tool(command)
+
+        self._last_early_tool = self._early_tools[command.id] = asyncio.create_task(run())
+        return self._last_early_tool
+
+    async def tool_result(self, command: ToolCall) -> Any:
+        """Result of a tool call, awaited if it was dispatched early, executed now otherwise"""
+        task = self._early_tools.pop(command.id, None)
+        if task is None or task.cancelled():
+            return await self.run_tool(command)
+        return await task
+
+    def drop_early_tools(self) -> None:
+        """Forget dispatched calls the final response did not contain, e.g. of a retried request"""
+        for call_id, task in self._early_tools.items():
+            logger.warning(f"Discarding early tool call {call_id} missing from the response")
+            task.cancel()
+        self._early_tools.clear()
+        self._last_early_tool = None
+
     async def step(self) -> str:
         """Execute a single step: think and act."""
         should_act = await self.think()
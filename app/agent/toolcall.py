@@ -1,5 +1,5 @@
 import json
-from typing import Any, List, Optional, Union
+from typing import Any, List, Optional, Tuple, Union
 
 from pydantic import Field
 
@@ -37,6 +37,7 @@ class ToolCallAgent(ReActAgent):
 
     async def think(self) -> bool:
         """Process current state and decide next actions using tools"""
+        self.drop_early_tools()
         if self.next_step_prompt:
             user_msg = Message.user_message(self.next_step_prompt)
             self.messages += [user_msg]
@@ -52,6 +53,8 @@ class ToolCallAgent(ReActAgent):
                 ),
                 tools=self.available_tools.to_params(),
                 tool_choice=self.tool_choices,
+                # a streamed response starts each tool call once its arguments are complete
+                on_tool_call=self.dispatch_tool if self.tool_choices != ToolChoice.NONE else None,
             )
         except ValueError:
             raise
@@ -140,10 +143,7 @@ class ToolCallAgent(ReActAgent):
 
         results = []
         for command in self.tool_calls:
-            # Reset base64_image for each tool call
-            self._current_base64_image = None
-
-            result = await self.execute_tool(command)
+            result, base64_image = await self.tool_result(command)
 
             if self.max_observe:
                 result = result[: self.max_observe]
@@ -157,13 +157,24 @@ class ToolCallAgent(ReActAgent):
                 content=result,
                 tool_call_id=command.id,
                 name=command.function.name,
-                base64_image=self._current_base64_image,
+                base64_image=base64_image,
             )
+            # written as each tool finishes, so a tool writing memory itself stays in order
             await self.update_memory_message(tool_msg)
             results.append(result)
-
+        self.drop_early_tools()
         return "\n\n".join(results)
 
+    def can_dispatch_early(self, command: ToolCall) -> bool:
+        return self.available_tools.idempotent(command.function.name)
+
+    async def run_tool(self, command: ToolCall) -> Tuple[str, Optional[str]]:
+        """Result of a tool call with the image it produced, if any"""
+        # Reset base64_image for each tool call
+        self._current_base64_image = None
+        result = await self.execute_tool(command)
+        return result, self._current_base64_image
+
     async def execute_tool(self, command: ToolCall) -> str:
         """Execute a single tool call with robust error handling"""
         if not command or not command.function or not command.function.name:
@@ -33,6 +33,10 @@ class AsyncTimer:
             t.__init__(timeout=time - current, callback_id=id, **args)
             t._start()
 
+    @classmethod
+    def pending(cls, callback_id) -> bool:
+        return any(t._callback_id == callback_id for t in cls.timers)
+
     def _start(self):
         self._task = asyncio.run_coroutine_threadsafe(self._job(), asyncio.get_event_loop())
         if not self in self.timers:
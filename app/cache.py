@@ -0,0 +1,227 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from os import makedirs, path
+from typing import Any, Callable, Dict, Optional
+
+
+CACHE_DB_FILE = "data/db/cache.db"
+
+
+class LRUCache:
+    """Bounded in-memory LRU map, `on_evict(key, value)` is called for entries pushed out"""
+
+    def __init__(self, max_entries: int = 1024, on_evict: Optional[Callable] = None):
+        self.max_entries = max_entries
+        self.on_evict = on_evict
+        self._data: OrderedDict = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key) -> bool:
+        return key in self._data
+
+    def get(self, key: str):
+        if key not in self._data:
+            return None
+        self._data.move_to_end(key)
+        return self._data[key]
+
+    def peek(self, key: str):
+        """Value of `key` without making it recently used"""
+        return self._data.get(key)
+
+    def put(self, key: str, value) -> None:
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            old_key, old = self._data.popitem(last=False)
+            if self.on_evict is not None:
+                self.on_evict(old_key, old)
+
+    def pop(self, key: str):
+        return self._data.pop(key, None)
+
+    def values(self):
+        return list(self._data.values())
+
+    def clear(self) -> None:
+        self._data.clear()
+
+
+class SQLiteCache:
+    """Persistent key/BLOB cache in one SQLite table.
+
+    Entries are evicted least-recently-used first once the table holds more than
+    `max_bytes`, and expire `ttl` seconds after they were written (0 never expires).
+    """
+
+    def __init__(self, table: str, file: str = CACHE_DB_FILE, max_bytes: int = 256 << 20, ttl: float = 0):
+        self.table = table
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        if path.dirname(file):
+            makedirs(path.dirname(file), exist_ok=True)
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(file, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            f"CREATE TABLE IF NOT EXISTS [{table}] (key TEXT PRIMARY KEY, value BLOB, "
+            "size INTEGER, created REAL, accessed REAL)"
+        )
+        self.conn.execute(f"CREATE INDEX IF NOT EXISTS [{table}_accessed] ON [{table}] (accessed)")
+        self.conn.commit()
+        self.total_bytes = self.conn.execute(f"SELECT COALESCE(SUM(size), 0) FROM [{table}]").fetchone()[0]
+
+    def get(self, key: str) -> Optional[bytes]:
+        now = time.time()
+        with self._lock:
+            row = self.conn.execute(f"SELECT value, created, size FROM [{self.table}] WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            value, created, size = row
+            if self.ttl and now - created > self.ttl:
+                self.conn.execute(f"DELETE FROM [{self.table}] WHERE key = ?", (key,))
+                self.total_bytes -= size
+                self.conn.commit()
+                return None
+            self.conn.execute(f"UPDATE [{self.table}] SET accessed = ? WHERE key = ?", (now, key))
+            self.conn.commit()
+        return value
+
+    def put(self, key: str, value: bytes) -> None:
+        now = time.time()
+        with self._lock:
+            old = self.conn.execute(f"SELECT size FROM [{self.table}] WHERE key = ?", (key,)).fetchone()
+            self.conn.execute(
+                f"INSERT OR REPLACE INTO [{self.table}] (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value), now, now),
+            )
+            self.total_bytes += len(value) - (old[0] if old else 0)
+            self._evict()
+            self.conn.commit()
+
+    def _evict(self) -> None:
+        while self.total_bytes > self.max_bytes:
+            rows = self.conn.execute(
+                f"SELECT key, size FROM [{self.table}] ORDER BY accessed LIMIT 64"
+            ).fetchall()
+            if not rows:
+                self.total_bytes = 0
+                return
+            self.conn.executemany(f"DELETE FROM [{self.table}] WHERE key = ?", [(k,) for k, _ in rows])
+            self.total_bytes -= sum(size for _, size in rows)
+
+    def close(self) -> None:
+        with self._lock:
+            self.conn.close()
+
+
+def normalize_content(content: str) -> str:
+    """Unicode NFC, trimmed, whitespace runs collapsed"""
+    return " ".join(unicodedata.normalize("NFC", content).split())
+
+
+class EmbeddingCache:
+    """Embedding cache keyed by (model, normalized content hash), LRU in memory in front of SQLite"""
+
+    def __init__(self, model: str, max_entries: int = 1024, max_bytes: int = 256 << 20, file: str = CACHE_DB_FILE):
+        self.model = model
+        self.memory = LRUCache(max_entries)
+        self.disk = SQLiteCache("Embedding", file=file, max_bytes=max_bytes) if max_bytes else None
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def key(self, content: str) -> str:
+        return hashlib.sha256(f"{self.model}\0{normalize_content(content)}".encode()).hexdigest()
+
+    def get(self, content: str) -> Optional[bytes]:
+        key = self.key(content)
+        value = self.memory.get(key)
+        if value is not None:
+            self.memory_hits += 1
+            return value
+        value = self.disk.get(key) if self.disk else None
+        if value is not None:
+            self.disk_hits += 1
+            self.memory.put(key, value)
+            return value
+        self.misses += 1
+        return None
+
+    def put(self, content: str, value: bytes) -> None:
+        key = self.key(content)
+        self.memory.put(key, value)
+        if self.disk:
+            self.disk.put(key, value)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.memory_hits + self.disk_hits + self.misses
+        return (self.memory_hits + self.disk_hits) / total if total else 0.0
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+        }
+
+
+def request_key(namespace: str, kind: str, params: Dict[str, Any], exclude=("timeout",)) -> str:
+    """SHA-256 of the canonical JSON of a request, None values and `exclude` params left out"""
+    request = {k: v for k, v in params.items() if k not in exclude and v is not None}
+    canonical = json.dumps(request, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+    return hashlib.sha256(f"{namespace}\0{kind}\0{canonical}".encode()).hexdigest()
+
+
+class ResponseCache:
+    """Completion cache keyed by a canonical hash of the request, persisted in SQLite.
+
+    The key covers everything that shapes the response: endpoint, model,
+    messages, tools, tool_choice and sampling params. `exclude` names request
+    params that do not (timeout, streaming, the end-user id).
+    """
+
+    def __init__(
+        self,
+        namespace: str,
+        max_bytes: int = 64 << 20,
+        ttl: float = 0,
+        exclude=("timeout", "stream", "stream_options", "user"),
+        file: str = CACHE_DB_FILE,
+    ):
+        self.namespace = namespace
+        self.exclude = set(exclude)
+        self.disk = SQLiteCache("Response", file=file, max_bytes=max_bytes, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, kind: str, params: Dict[str, Any]) -> str:
+        return request_key(self.namespace, kind, params, self.exclude)
+
+    def get(self, key: str) -> Optional[str]:
+        value = self.disk.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value.decode()
+
+    def put(self, key: str, value: str) -> None:
+        self.disk.put(key, value.encode())
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> Dict[str, float]:
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hit_rate}
@@ -1,7 +1,7 @@
 import threading
 import tomllib
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Dict, List, Literal, Optional
 
 from pydantic import BaseModel, Field
 
@@ -25,8 +25,53 @@ class LLMSettings(BaseModel):
         description="Maximum input tokens to use across all requests (None for unlimited)",
     )
     temperature: float = Field(1.0, description="Sampling temperature")
+    context_window: int = Field(
+        32768, description="Model context window in tokens, prompt and completion together"
+    )
+    stream_tools: bool = Field(
+        False, description="Stream ask_tool responses, text is shown as it arrives"
+    )
     api_type: str = Field(..., description="Azure, Openai, or Ollama")
     api_version: str = Field(..., description="Azure Openai version if AzureOpenai")
+    requests_per_minute: int = Field(
+        0, description="Requests per minute admitted for this config, 0 for no limit"
+    )
+    tokens_per_minute: int = Field(
+        0, description="Input and completion tokens per minute admitted for this config, 0 for no limit"
+    )
+    max_in_flight: int = Field(
+        0, description="Requests of this config sent at the same time, 0 for no limit"
+    )
+    single_flight: bool = Field(
+        True, description="Identical concurrent requests share one API call"
+    )
+    response_cache: bool = Field(
+        False, description="Cache responses of temperature 0 requests on disk, keyed by the request"
+    )
+    response_cache_mb: int = Field(
+        64, description="Size limit of the response cache in MB, least recently used entries go first"
+    )
+    response_cache_ttl: float = Field(
+        86400, description="Seconds a cached response stays valid, 0 never expires"
+    )
+    embedding_cache: bool = Field(
+        True, description="Cache embeddings by content hash (embedding models only)"
+    )
+    embedding_cache_entries: int = Field(
+        1024, description="Embeddings kept in the in-memory LRU tier"
+    )
+    embedding_cache_mb: int = Field(
+        256, description="Size limit of the persistent SQLite tier in MB, 0 disables it"
+    )
+    embedding_max_tokens: int = Field(
+        8191, description="Input limit of the embedding model, longer contents are truncated"
+    )
+    embedding_batch_size: int = Field(
+        64, description="Max embedding inputs per API call, 1 disables batching"
+    )
+    embedding_batch_window: float = Field(
+        0.02, description="Seconds to wait for more embedding requests before sending a batch"
+    )
 
 
 class ProxySettings(BaseModel):
@@ -81,6 +126,108 @@ class AgentSettings(BaseModel):
     )
 
 
+class MemorySettings(BaseModel):
+    embedding_dtype: Literal["float32", "float16"] = Field(
+        "float32", description="Storage type of embedding BLOBs in the memory db"
+    )
+    commit_interval: float = Field(
+        1.0, description="Group-commit interval in seconds for the memory db, 0 commits every message"
+    )
+    hot_messages: int = Field(
+        100, description="Messages kept in RAM, older ones move to the disk-backed cold tier"
+    )
+    load_window: int = Field(
+        100, description="Messages loaded at startup, older ones are paged in from the db on demand, 0 loads all"
+    )
+    ann_enabled: bool = Field(
+        False, description="Use an approximate nearest-neighbour index for related messages"
+    )
+    ann_nlist: int = Field(
+        0, description="Number of IVF lists, 0 for sqrt(number of vectors)"
+    )
+    ann_nprobe: int = Field(
+        8, description="IVF lists scanned per query, higher is better recall but slower"
+    )
+    ann_min_size: int = Field(
+        10000, description="Below this number of vectors a brute-force scan is used"
+    )
+    ann_rebuild_ratio: float = Field(
+        0.2, description="Rebuild the index when vectors added since training exceed this ratio"
+    )
+    index_dtype: Literal["float32", "float16", "int8"] = Field(
+        "float32", description="Storage type of the in-memory/memory-mapped search vectors, int8 is per-vector scaled"
+    )
+    rerank_factor: int = Field(
+        4, description="With a quantized index, re-rank this many times the requested candidates exactly, 1 disables"
+    )
+    hybrid_search: bool = Field(
+        True, description="Fuse full-text (BM25) and embedding rankings for related messages"
+    )
+    hybrid_candidates: int = Field(
+        20, description="Candidates taken from each ranking before fusion"
+    )
+    rrf_k: int = Field(
+        60, description="Reciprocal-rank fusion constant, higher flattens the rank weights"
+    )
+    decay_weight: float = Field(
+        0.2, description="Share of a related message's relevance that fades with its age, 0 ignores age"
+    )
+    decay_half_life: float = Field(
+        30.0, description="Days after which the fading share of the relevance is halved"
+    )
+    mmr_lambda: float = Field(
+        0.7, description="Relevance vs. novelty trade-off when picking related messages, 1 ignores redundancy"
+    )
+    context_budget: bool = Field(
+        True, description="Fill the prompt by token budget instead of fixed recent/related message counts"
+    )
+    context_related_share: float = Field(
+        0.3, description="Share of the context budget held back from recent messages for related ones"
+    )
+    context_item_share: float = Field(
+        0.25, description="Largest share of the context budget one message may take, longer ones are truncated"
+    )
+    embed_workers: int = Field(
+        2, description="Background workers embedding new messages"
+    )
+    embed_queue_size: int = Field(
+        256, description="Messages waiting for embedding before adding a message blocks"
+    )
+    embed_retries: int = Field(
+        3, description="Retries of a failed embedding request, with exponential backoff"
+    )
+    embed_wait: float = Field(
+        0.5, description="Seconds to wait for the query embedding when building context, lexical search is used after that"
+    )
+    compaction_interval: int = Field(
+        3600, description="Seconds between background compactions of old turns into summaries, 0 disables"
+    )
+    compaction_llm: str = Field(
+        "summary", description="LLM config ([llm.<name>]) used to summarize episodes, compaction is skipped if it does not exist"
+    )
+    compaction_keep: int = Field(
+        200, description="Newest messages never compacted"
+    )
+    compaction_batch: int = Field(
+        8, description="Episodes summarized per compaction run"
+    )
+    episode_gap: int = Field(
+        1800, description="Seconds of silence that end an episode"
+    )
+    episode_max_messages: int = Field(
+        60, description="Messages per episode at most, twice that if no user message comes to break it"
+    )
+    episode_max_tokens: int = Field(
+        6000, description="Tokens per episode at most, bounds the summarizer input"
+    )
+    session_dir: str = Field(
+        "data/db/sessions", description="Directory of the per-session memory databases"
+    )
+    max_open_sessions: int = Field(
+        16, description="Session memories kept open, the least recently used one is closed beyond that"
+    )
+
+
 class AppConfig(BaseModel):
     llm: Dict[str, LLMSettings]
     browser_config: Optional[BrowserSettings] = Field(
@@ -92,6 +239,9 @@ class AppConfig(BaseModel):
     agent_config: Optional[AgentSettings] = Field(
         None, description="Agent configuration"
     )
+    memory_config: Optional[MemorySettings] = Field(
+        None, description="Memory configuration"
+    )
 
     class Config:
         arbitrary_types_allowed = True
@@ -151,6 +301,15 @@ class Config:
             "api_key": base_llm.get("api_key"),
             "max_tokens": base_llm.get("max_tokens", 4096),
             "max_input_tokens": base_llm.get("max_input_tokens"),
+            "context_window": base_llm.get("context_window", 32768),
+            "stream_tools": base_llm.get("stream_tools", False),
+            "single_flight": base_llm.get("single_flight", True),
+            "requests_per_minute": base_llm.get("requests_per_minute", 0),
+            "tokens_per_minute": base_llm.get("tokens_per_minute", 0),
+            "max_in_flight": base_llm.get("max_in_flight", 0),
+            "response_cache": base_llm.get("response_cache", False),
+            "response_cache_mb": base_llm.get("response_cache_mb", 64),
+            "response_cache_ttl": base_llm.get("response_cache_ttl", 86400),
             "temperature": base_llm.get("temperature", 1.0),
             "api_type": base_llm.get("api_type", ""),
             "api_version": base_llm.get("api_version", ""),
@@ -197,6 +356,10 @@ class Config:
         agent_settings = None
         if agent_config:
             agent_settings = AgentSettings(**agent_config)
+        memory_config = raw_config.get("memory", {})
+        memory_settings = None
+        if memory_config:
+            memory_settings = MemorySettings(**memory_config)
         config_dict = {
             "llm": {
                 "default": default_settings,
@@ -208,6 +371,7 @@ class Config:
             "browser_config": browser_settings,
             "search_config": search_settings,
             "agent_config": agent_settings,
+            "memory_config": memory_settings,
         }
 
         self._config = AppConfig(**config_dict)
@@ -228,6 +392,10 @@ class Config:
     def agent_config(self) -> Optional[AgentSettings]:
         return self._config.agent_config
 
+    @property
+    def memory_config(self) -> Optional[MemorySettings]:
+        return self._config.memory_config
+
     @property
     def workspace_root(self) -> Path:
         """Get the workspace root directory"""
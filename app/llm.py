@@ -1,6 +1,9 @@
+import asyncio
+from contextlib import asynccontextmanager
+import hashlib
 import math
 import json
-from typing import Dict, List, Optional, Union
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, List, Optional, Tuple, Union
 
 import tiktoken
 from openai import (
@@ -8,10 +11,12 @@ from openai import (
     AsyncAzureOpenAI,
     AsyncOpenAI,
     AuthenticationError,
+    BadRequestError,
     OpenAIError,
     RateLimitError,
 )
 from openai.types.chat.chat_completion_message import ChatCompletionMessage
+from openai.types.chat.chat_completion_message_tool_call import ChatCompletionMessageToolCall
 from tenacity import (
     retry,
     retry_if_exception_type,
@@ -20,19 +25,24 @@ from tenacity import (
 )
 
 from app.bedrock import BedrockClient
+from app.cache import EmbeddingCache, ResponseCache, request_key
 from app.config import LLMSettings, config
 from app.exceptions import TokenLimitExceeded
 from app.logger import logger  # Assuming a logger is set up in your app
+from app.memory import encode_embedding
+from app.rate_limit import RateLimiter, retry_after
 from app.schema import (
     ROLE_VALUES,
     TOOL_CHOICE_TYPE,
     TOOL_CHOICE_VALUES,
     Message,
+    MessageRecord,
     ToolChoice,
 )
 
 
 REASONING_MODELS = ["o1", "o3-mini"]
+TRUNCATED_MARK = "\n...[truncated]"
 MULTIMODAL_MODELS = [
     "gpt-4-vision-preview",
     "gpt-4o",
@@ -43,6 +53,18 @@ MULTIMODAL_MODELS = [
 ]
 
 
+_backoff = wait_random_exponential(min=1, max=60)
+
+
+def retry_wait(retry_state) -> float:
+    """Random exponential backoff, except for a 429 that said how long to wait:
+    the rate limiter already holds the retry for its Retry-After."""
+    error = retry_state.outcome.exception()
+    if isinstance(error, RateLimitError) and retry_after(error) is not None:
+        return 0
+    return _backoff(retry_state)
+
+
 class TokenCounter:
     # Token constants
     BASE_MESSAGE_TOKENS = 4
@@ -57,6 +79,7 @@ class TokenCounter:
 
     def __init__(self, tokenizer):
         self.tokenizer = tokenizer
+        self._tool_tokens: Dict[str, int] = {}
 
     def count_text(self, text: str) -> int:
         """Calculate tokens for a text string"""
@@ -152,31 +175,44 @@ class TokenCounter:
                 token_count += self.count_text(function.get("arguments", ""))
         return token_count
 
-    def count_message_tokens(self, messages: List[dict]) -> int:
-        """Calculate the total number of tokens in a message list"""
-        total_tokens = self.FORMAT_TOKENS  # Base format tokens
+    def count_message(self, message: dict) -> int:
+        """Calculate the tokens of one formatted message"""
+        tokens = self.BASE_MESSAGE_TOKENS  # Base tokens per message
 
-        for message in messages:
-            tokens = self.BASE_MESSAGE_TOKENS  # Base tokens per message
+        # Add role tokens
+        tokens += self.count_text(message.get("role", ""))
+
+        # Add content tokens
+        if "content" in message:
+            tokens += self.count_content(message["content"])
 
-            # Add role tokens
-            tokens += self.count_text(message.get("role", ""))
+        # Add tool calls tokens
+        if "tool_calls" in message:
+            tokens += self.count_tool_calls(message["tool_calls"])
 
-            # Add content tokens
-            if "content" in message:
-                tokens += self.count_content(message["content"])
+        # Add name and tool_call_id tokens
+        tokens += self.count_text(message.get("name", ""))
+        tokens += self.count_text(message.get("tool_call_id", ""))
 
-            # Add tool calls tokens
-            if "tool_calls" in message:
-                tokens += self.count_tool_calls(message["tool_calls"])
+        return tokens
 
-            # Add name and tool_call_id tokens
-            tokens += self.count_text(message.get("name", ""))
-            tokens += self.count_text(message.get("tool_call_id", ""))
+    def count_message_tokens(self, messages: List[dict]) -> int:
+        """Calculate the total number of tokens in a message list"""
+        return self.sum_message_tokens(self.count_message(message) for message in messages)
 
-            total_tokens += tokens
+    def sum_message_tokens(self, counts: Iterable[int]) -> int:
+        """Total tokens of a message list from per-message counts"""
+        return self.FORMAT_TOKENS + sum(counts)
 
-        return total_tokens
+    def count_tools(self, tools: List[dict]) -> int:
+        """Tokens of the tool schemas, each schema encoded once and cached by its hash"""
+        token_count = 0
+        for tool in tools:
+            key = hashlib.sha1(json.dumps(tool, sort_keys=True, default=str).encode()).hexdigest()
+            if key not in self._tool_tokens:
+                self._tool_tokens[key] = self.count_text(str(tool))
+            token_count += self._tool_tokens[key]
+        return token_count
 
 
 class LLM:
@@ -217,6 +253,7 @@ class LLM:
             if hasattr(llm_config, "max_input_tokens")
             else None
         )
+        self.context_window = llm_config.context_window
 
         # Initialize tokenizer
         try:
@@ -225,18 +262,120 @@ class LLM:
             # If the model is not in tiktoken's presets, use cl100k_base as default
             self.tokenizer = tiktoken.get_encoding("cl100k_base")
 
+        self.rate_limiter = RateLimiter(
+            llm_config.requests_per_minute,
+            llm_config.tokens_per_minute,
+            llm_config.max_in_flight,
+        )
+        # with limits set, 429s come straight back so the limiter sees their Retry-After
+        client_retries = {"max_retries": 0} if self.rate_limiter.enabled else {}
+
         if self.api_type == "azure":
             self.client = AsyncAzureOpenAI(
                 base_url=self.base_url,
                 api_key=self.api_key,
                 api_version=self.api_version,
+                **client_retries,
             )
         elif self.api_type == "aws":
             self.client = BedrockClient()
         else:
-            self.client = AsyncOpenAI(api_key=self.api_key, base_url=self.base_url)
+            self.client = AsyncOpenAI(api_key=self.api_key, base_url=self.base_url, **client_retries)
 
         self.token_counter = TokenCounter(self.tokenizer)
+        self.llm_config = llm_config
+        self._embedding_cache = None
+        self._response_cache = None
+        # requests being sent, by request key: [task, callers waiting]
+        self._inflight: Dict[Hashable, list] = {}
+        self._embedding_batch: List[tuple] = []
+        self._embedding_flush: Optional[asyncio.TimerHandle] = None
+        self._embedding_loop: Optional[asyncio.AbstractEventLoop] = None
+        self._embedding_tasks: set = set()
+
+    @property
+    def embedding_cache(self) -> Optional[EmbeddingCache]:
+        """Created on first use, so only configs that embed open the cache db"""
+        if self._embedding_cache is None and self.llm_config.embedding_cache:
+            self._embedding_cache = EmbeddingCache(
+                self.model,
+                max_entries=self.llm_config.embedding_cache_entries,
+                max_bytes=self.llm_config.embedding_cache_mb << 20,
+            )
+        return self._embedding_cache
+
+    @property
+    def response_cache(self) -> Optional[ResponseCache]:
+        """Created on first use when `response_cache` is enabled for this config"""
+        if self._response_cache is None and self.llm_config.response_cache:
+            self._response_cache = ResponseCache(
+                self.base_url or "",
+                max_bytes=self.llm_config.response_cache_mb << 20,
+                ttl=self.llm_config.response_cache_ttl,
+            )
+        return self._response_cache
+
+    def _request_key(self, kind: str, params: dict) -> str:
+        """Hash identifying a request for in-flight sharing"""
+        return request_key(self.base_url or "", kind, params)
+
+    def _cacheable(self, params: dict) -> bool:
+        """Only temperature 0 requests are cached: a sampled response replayed
+        forever would hide the variation the caller asked for."""
+        return self.response_cache is not None and params.get("temperature") == 0
+
+    @asynccontextmanager
+    async def _rate_limited(self, tokens: int):
+        """Hold a rate limiter slot for one API call estimated at `tokens` input tokens.
+
+        A 429 with a Retry-After header pauses admission for that long, so the
+        retry and every other request of this config wait it out together.
+        """
+        await self.rate_limiter.acquire(tokens)
+        try:
+            yield
+        except RateLimitError as e:
+            seconds = retry_after(e)
+            if seconds is not None:
+                logger.warning(f"Rate limited, pausing {self.config_name} requests for {seconds:.1f}s")
+                self.rate_limiter.pause(seconds)
+            raise
+        finally:
+            self.rate_limiter.release()
+
+    async def _single_flight(self, key: Hashable, send: Callable[[], Awaitable]) -> Tuple[Any, bool]:
+        """Result of `send()`, shared with identical requests already in flight.
+
+        Returns the result and whether it was joined rather than sent. Each
+        caller waits through `asyncio.shield`, so a caller being cancelled does
+        not cancel the shared request for the others; it is only cancelled
+        once every caller has gone.
+        """
+        flight = self._inflight.get(key)
+        joined = flight is not None and self.llm_config.single_flight
+        if joined:
+            logger.debug(f"Joining identical in-flight request {key}")
+            flight[1] += 1
+        else:
+            flight = [asyncio.ensure_future(send()), 1]
+            # nobody may be left to see how a cancelled-out request ended
+            flight[0].add_done_callback(lambda t: t.cancelled() or t.exception())
+            if self.llm_config.single_flight:
+                self._inflight[key] = flight
+                flight[0].add_done_callback(
+                    lambda _: self._inflight.pop(key) if self._inflight.get(key) is flight else None
+                )
+        task = flight[0]
+        try:
+            return await asyncio.shield(task), joined
+        except asyncio.CancelledError:
+            flight[1] -= 1
+            if flight[1] == 0:
+                # gone from the table before the task ends, a new caller must not join it
+                if self._inflight.get(key) is flight:
+                    del self._inflight[key]
+                task.cancel()
+            raise
 
     def count_tokens(self, text: str) -> int:
         """Calculate the number of tokens in a text"""
@@ -247,15 +386,65 @@ class LLM:
     def count_message_tokens(self, messages: List[dict]) -> int:
         return self.token_counter.count_message_tokens(messages)
 
+    def count_message(self, message: Union[dict, Message, MessageRecord]) -> int:
+        """Tokens one message adds to a request"""
+        # format_messages edits dicts in place, count on a copy
+        message = message if isinstance(message, (Message, MessageRecord)) else dict(message)
+        formatted = self.format_messages([message], self.model in MULTIMODAL_MODELS)
+        return sum(self.token_counter.count_message(m) for m in formatted)
+
+    def count_input_tokens(
+        self, messages: List[Union[dict, Message, MessageRecord]], tools: Optional[List[dict]] = None
+    ) -> int:
+        """Input tokens of a request, summing the counts cached on `Message.tokens`"""
+        counts = []
+        for message in messages:
+            if isinstance(message, (Message, MessageRecord)):
+                if message.tokens is None:
+                    message.tokens = self.count_message(message)
+                counts.append(message.tokens)
+            else:
+                counts.append(self.count_message(message))
+        return self.token_counter.sum_message_tokens(counts) + self.token_counter.count_tools(tools or [])
+
+    def truncate_text(self, text: str, max_tokens: int) -> str:
+        """Cut `text` to at most `max_tokens` tokens, marking the cut"""
+        tokens = self.tokenizer.encode(text or "")
+        if len(tokens) <= max_tokens:
+            return text
+        mark = len(self.tokenizer.encode(TRUNCATED_MARK))
+        return self.tokenizer.decode(tokens[: max(max_tokens - mark, 0)]) + TRUNCATED_MARK
+
+    def context_budget(
+        self,
+        fixed_messages: Optional[List[Union[dict, Message]]] = None,
+        tools: Optional[List[dict]] = None,
+    ) -> int:
+        """Input tokens left for context messages once the fixed prompt, tools and completion are reserved"""
+        budget = self.context_window - self.max_tokens
+        if fixed_messages:
+            formatted = self.format_messages(fixed_messages, self.model in MULTIMODAL_MODELS)
+            budget -= self.count_message_tokens(formatted)
+        else:
+            budget -= TokenCounter.FORMAT_TOKENS
+        if tools:
+            budget -= self.token_counter.count_tools(tools)
+        if self.max_input_tokens is not None:
+            budget = min(budget, self.max_input_tokens - self.total_input_tokens)
+        return max(budget, 0)
+
     def update_token_count(self, input_tokens: int, completion_tokens: int = 0) -> None:
         """Update token counts"""
         # Only track tokens if max_input_tokens is set
         self.total_input_tokens += input_tokens
         self.total_completion_tokens += completion_tokens
+        # input tokens were reserved on admission
+        self.rate_limiter.charge(completion_tokens)
         logger.info(
             f"Token usage: Input={input_tokens}, Completion={completion_tokens}, "
             f"Cumulative Input={self.total_input_tokens}, Cumulative Completion={self.total_completion_tokens}, "
             f"Total={input_tokens + completion_tokens}, Cumulative Total={self.total_input_tokens + self.total_completion_tokens}"
+            + (f", Response cache={self._response_cache.stats()}" if self._response_cache else "")
         )
 
     def check_token_limit(self, input_tokens: int) -> bool:
@@ -286,7 +475,7 @@ class LLM:
 
     @staticmethod
     def format_messages(
-        messages: List[Union[dict, Message]], supports_images: bool = False
+        messages: List[Union[dict, Message, MessageRecord]], supports_images: bool = False
     ) -> List[dict]:
         """
         Format messages for LLM by converting them to OpenAI message format.
@@ -313,8 +502,8 @@ class LLM:
         formatted_messages = []
 
         for message in messages:
-            # Convert Message objects to dictionaries
-            if isinstance(message, Message):
+            # Convert Message objects (and the records memory keeps) to dictionaries
+            if isinstance(message, (Message, MessageRecord)):
                 message = message.to_dict()
 
             if isinstance(message, dict):
@@ -373,7 +562,7 @@ class LLM:
         return formatted_messages
 
     @retry(
-        wait=wait_random_exponential(min=1, max=60),
+        wait=retry_wait,
         stop=stop_after_attempt(6),
         retry=retry_if_exception_type(
             (OpenAIError, Exception, ValueError)
@@ -408,6 +597,9 @@ class LLM:
             # Check if the model supports images
             supports_images = self.model in MULTIMODAL_MODELS
 
+            # Calculate input token count
+            input_tokens = self.count_input_tokens((system_msgs or []) + messages)
+
             # Format system and user messages with image support check
             if system_msgs:
                 system_msgs = self.format_messages(system_msgs, supports_images)
@@ -415,9 +607,6 @@ class LLM:
             else:
                 messages = self.format_messages(messages, supports_images)
 
-            # Calculate input token count
-            input_tokens = self.count_message_tokens(messages)
-
             # Check if token limits are exceeded
             if not self.check_token_limit(input_tokens):
                 error_message = self.get_limit_error_message(input_tokens)
@@ -437,6 +626,47 @@ class LLM:
                     temperature if temperature is not None else self.temperature
                 )
 
+            key = self._request_key("ask", params)
+            cache_key = self.response_cache.key("ask", params) if self._cacheable(params) else None
+            if cache_key:
+                cached = self.response_cache.get(cache_key)
+                if cached is not None:
+                    if stream:
+                        print(cached)
+                    self.update_token_count(0)
+                    return cached
+
+            response, joined = await self._single_flight(
+                key, lambda: self._send_ask(params, input_tokens, stream, cache_key)
+            )
+            if joined and stream:
+                print(response)
+            return response
+
+        except TokenLimitExceeded:
+            # Re-raise token limit errors without logging
+            raise
+        except ValueError:
+            logger.exception(f"Validation error")
+            raise
+        except OpenAIError as oe:
+            logger.exception(f"OpenAI API error")
+            if isinstance(oe, AuthenticationError):
+                logger.error("Authentication failed. Check API key.")
+            elif isinstance(oe, RateLimitError):
+                logger.error("Rate limit exceeded. Consider increasing retry attempts.")
+            elif isinstance(oe, APIError):
+                logger.error(f"API error: {oe}")
+            raise
+        except Exception:
+            logger.exception(f"Unexpected error in ask")
+            raise
+
+    async def _send_ask(
+        self, params: dict, input_tokens: int, stream: bool, cache_key: Optional[str]
+    ) -> str:
+        """API call of `ask`, shared by identical concurrent requests"""
+        async with self._rate_limited(input_tokens):
             if not stream:
                 # Non-streaming request
                 response = await self.client.chat.completions.create(
@@ -449,7 +679,10 @@ class LLM:
                 # Update token counts
                 if response.usage:
                     self.update_token_count(response.usage.prompt_tokens)
+                    self.rate_limiter.charge(response.usage.completion_tokens)
 
+                if cache_key:
+                    self.response_cache.put(cache_key, response.choices[0].message.content)
                 return response.choices[0].message.content
 
             # Streaming request, For streaming, update estimated token count before making the request
@@ -478,30 +711,14 @@ class LLM:
                 f"Estimated completion tokens for streaming response: {completion_tokens}"
             )
             self.total_completion_tokens += completion_tokens
+            self.rate_limiter.charge(completion_tokens)
 
+            if cache_key:
+                self.response_cache.put(cache_key, full_response)
             return full_response
 
-        except TokenLimitExceeded:
-            # Re-raise token limit errors without logging
-            raise
-        except ValueError:
-            logger.exception(f"Validation error")
-            raise
-        except OpenAIError as oe:
-            logger.exception(f"OpenAI API error")
-            if isinstance(oe, AuthenticationError):
-                logger.error("Authentication failed. Check API key.")
-            elif isinstance(oe, RateLimitError):
-                logger.error("Rate limit exceeded. Consider increasing retry attempts.")
-            elif isinstance(oe, APIError):
-                logger.error(f"API error: {oe}")
-            raise
-        except Exception:
-            logger.exception(f"Unexpected error in ask")
-            raise
-
     @retry(
-        wait=wait_random_exponential(min=1, max=60),
+        wait=retry_wait,
         stop=stop_after_attempt(6),
         retry=retry_if_exception_type(
             (OpenAIError, Exception, ValueError)
@@ -610,33 +827,35 @@ class LLM:
                     temperature if temperature is not None else self.temperature
                 )
 
-            # Handle non-streaming request
-            if not stream:
-                response = await self.client.chat.completions.create(**params)
+            async with self._rate_limited(input_tokens):
+                # Handle non-streaming request
+                if not stream:
+                    response = await self.client.chat.completions.create(**params)
 
-                if not response.choices or not response.choices[0].message.content:
-                    raise ValueError("Empty or invalid response from LLM")
+                    if not response.choices or not response.choices[0].message.content:
+                        raise ValueError("Empty or invalid response from LLM")
 
-                self.update_token_count(response.usage.prompt_tokens)
-                return response.choices[0].message.content
+                    self.update_token_count(response.usage.prompt_tokens)
+                    self.rate_limiter.charge(response.usage.completion_tokens)
+                    return response.choices[0].message.content
 
-            # Handle streaming request
-            self.update_token_count(input_tokens)
-            response = await self.client.chat.completions.create(**params)
+                # Handle streaming request
+                self.update_token_count(input_tokens)
+                response = await self.client.chat.completions.create(**params)
 
-            collected_messages = []
-            async for chunk in response:
-                chunk_message = chunk.choices[0].delta.content or ""
-                collected_messages.append(chunk_message)
-                print(chunk_message, end="", flush=True)
+                collected_messages = []
+                async for chunk in response:
+                    chunk_message = chunk.choices[0].delta.content or ""
+                    collected_messages.append(chunk_message)
+                    print(chunk_message, end="", flush=True)
 
-            print()  # Newline after streaming
-            full_response = "".join(collected_messages).strip()
+                print()  # Newline after streaming
+                full_response = "".join(collected_messages).strip()
 
-            if not full_response:
-                raise ValueError("Empty response from streaming LLM")
+                if not full_response:
+                    raise ValueError("Empty response from streaming LLM")
 
-            return full_response
+                return full_response
 
         except TokenLimitExceeded:
             raise
@@ -657,7 +876,7 @@ class LLM:
             raise
 
     @retry(
-        wait=wait_random_exponential(min=1, max=60),
+        wait=retry_wait,
         stop=stop_after_attempt(6),
         retry=retry_if_exception_type(
             (OpenAIError, Exception, ValueError)
@@ -673,6 +892,9 @@ class LLM:
         temperature: Optional[float] = None,
         beta: bool = False,
         response_format = None,
+        stream: Optional[bool] = None,
+        on_token: Optional[Callable[[str], None]] = None,
+        on_tool_call: Optional[Callable[[ChatCompletionMessageToolCall], Any]] = None,
         **kwargs,
     ) -> ChatCompletionMessage | None:
         """
@@ -685,6 +907,9 @@ class LLM:
             tools: List of tools to use
             tool_choice: Tool choice strategy
             temperature: Sampling temperature for the response
+            stream: Stream the response, `stream_tools` of the config if None
+            on_token: Called with every streamed text chunk, printed if None
+            on_tool_call: Called with each streamed tool call as soon as its arguments are complete JSON
             **kwargs: Additional completion arguments
 
         Returns:
@@ -704,6 +929,9 @@ class LLM:
             # Check if the model supports images
             supports_images = self.model in MULTIMODAL_MODELS
 
+            # Calculate input token count, tool descriptions included
+            input_tokens = self.count_input_tokens((system_msgs or []) + messages, tools)
+
             # Format messages
             if system_msgs:
                 system_msgs = self.format_messages(system_msgs, supports_images)
@@ -711,33 +939,6 @@ class LLM:
             else:
                 messages = self.format_messages(messages, supports_images)
             logger.debug("\n".join([json.dumps(m, ensure_ascii=False) for m in messages]))
-            # Calculate input token count
-            input_tokens = self.count_message_tokens(messages)
-
-            # If there are tools, calculate token count for tool descriptions
-            tools_tokens = 0
-            if tools:
-                for tool in tools:
-                    tools_tokens += self.count_tokens(str(tool))
-
-            input_tokens += tools_tokens
-
-            # Check if token limits are exceeded
-            if not self.check_token_limit(input_tokens):
-                error_message = self.get_limit_error_message(input_tokens)
-                # Raise a special exception that won't be retried
-                raise TokenLimitExceeded(error_message)
-
-            # Calculate input token count
-            input_tokens = self.count_message_tokens(messages)
-
-            # If there are tools, calculate token count for tool descriptions
-            tools_tokens = 0
-            if tools:
-                for tool in tools:
-                    tools_tokens += self.count_tokens(str(tool))
-
-            input_tokens += tools_tokens
 
             # Check if token limits are exceeded
             if not self.check_token_limit(input_tokens):
@@ -769,8 +970,69 @@ class LLM:
                 params["temperature"] = (
                     temperature if temperature is not None else self.temperature
                 )
+            if stream is None:
+                stream = self.llm_config.stream_tools
+            stream = stream and self.api_type != "aws"
+            key = self._request_key("ask_tool_beta" if beta else "ask_tool", params)
+            # parsed (beta) responses carry a pydantic object, they are not cached
+            cache_key = self.response_cache.key("ask_tool", params) if not beta and self._cacheable(params) else None
+            if cache_key:
+                cached = self.response_cache.get(cache_key)
+                if cached is not None:
+                    message = ChatCompletionMessage.model_validate_json(cached)
+                    if stream:
+                        self._replay_tool_response(message, on_token, on_tool_call)
+                    self.update_token_count(0)
+                    return message
+            message, joined = await self._single_flight(
+                key,
+                lambda: self._send_ask_tool(params, input_tokens, beta, stream, on_token, on_tool_call, cache_key),
+            )
+            if joined and message is not None:
+                # every caller gets its own copy, and its callbacks
+                message = message.model_copy(deep=True)
+                if stream:
+                    self._replay_tool_response(message, on_token, on_tool_call)
+            return message
+
+        except TokenLimitExceeded:
+            # Re-raise token limit errors without logging
+            raise
+        except ValueError as ve:
+            logger.error(f"Validation error in ask_tool: {ve}")
+            raise
+        except OpenAIError as oe:
+            logger.error(f"OpenAI API error: {oe}")
+            if isinstance(oe, AuthenticationError):
+                logger.error("Authentication failed. Check API key.")
+            elif isinstance(oe, RateLimitError):
+                logger.error("Rate limit exceeded. Consider increasing retry attempts.")
+            elif isinstance(oe, APIError):
+                logger.error(f"API error: {oe}")
+            raise
+        except Exception as e:
+            logger.error(f"Unexpected error in ask_tool: {e}")
+            raise
+
+    async def _send_ask_tool(
+        self,
+        params: dict,
+        input_tokens: int,
+        beta: bool,
+        stream: bool,
+        on_token: Optional[Callable[[str], None]],
+        on_tool_call: Optional[Callable[[ChatCompletionMessageToolCall], Any]],
+        cache_key: Optional[str],
+    ) -> ChatCompletionMessage | None:
+        """API call of `ask_tool`, shared by identical concurrent requests"""
+        async with self._rate_limited(input_tokens):
             if beta:
                 response = await self.client.beta.chat.completions.parse(**params)
+            elif stream:
+                message = await self._stream_tool_response(params, input_tokens, on_token, on_tool_call)
+                if cache_key and message:
+                    self.response_cache.put(cache_key, message.model_dump_json())
+                return message
             else:
                 response: ChatCompletion = await self.client.chat.completions.create(
                 **params, stream=False
@@ -787,42 +1049,231 @@ class LLM:
                 response.usage.prompt_tokens, response.usage.completion_tokens
             )
 
+            if cache_key:
+                self.response_cache.put(cache_key, response.choices[0].message.model_dump_json())
             return response.choices[0].message
 
-        except TokenLimitExceeded:
-            # Re-raise token limit errors without logging
-            raise
-        except ValueError as ve:
-            logger.error(f"Validation error in ask_tool: {ve}")
-            raise
-        except OpenAIError as oe:
-            logger.error(f"OpenAI API error: {oe}")
-            if isinstance(oe, AuthenticationError):
-                logger.error("Authentication failed. Check API key.")
-            elif isinstance(oe, RateLimitError):
-                logger.error("Rate limit exceeded. Consider increasing retry attempts.")
-            elif isinstance(oe, APIError):
-                logger.error(f"API error: {oe}")
-            raise
-        except Exception as e:
-            logger.error(f"Unexpected error in ask_tool: {e}")
+    async def _stream_tool_response(
+        self,
+        params: dict,
+        input_tokens: int,
+        on_token: Optional[Callable[[str], None]] = None,
+        on_tool_call: Optional[Callable[[ChatCompletionMessageToolCall], Any]] = None,
+    ) -> ChatCompletionMessage | None:
+        """Streamed `ask_tool` request, text chunks go to `on_token` as they arrive.
+
+        Tool-call deltas are joined by their index into whole calls, so the
+        result has the shape of a non-streamed response message. A call whose
+        arguments parse as a JSON object is complete (more deltas could only
+        make it invalid), it is handed to `on_tool_call` right away while the
+        rest of the message is still generated. Whatever `on_tool_call`
+        returns with a `cancel` method (e.g. the task it started) is cancelled
+        if the stream fails, so a retried request does not run its calls twice.
+        """
+        on_token = on_token or (lambda text: print(text, end="", flush=True))
+        # usage in the last chunk is an OpenAI extension other endpoints may reject
+        usage_option = {"stream_options": {"include_usage": True}} if self.api_type in ("", "openai") else {}
+        response = await self.client.chat.completions.create(**params, stream=True, **usage_option)
+        content, reasoning = [], []
+        calls: Dict[int, dict] = {}
+        dispatched = set()
+        usage = None
+        # what on_tool_call returned, cancelled if this attempt fails before it is retried
+        started = []
+        try:
+            async for chunk in response:
+                if chunk.usage:
+                    usage = chunk.usage
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta
+                # reasoning models (e.g. deepseek-reasoner) stream their thinking separately
+                thought = getattr(delta, "reasoning_content", None)
+                if thought:
+                    reasoning.append(thought)
+                    on_token(thought)
+                if delta.content:
+                    content.append(delta.content)
+                    on_token(delta.content)
+                for part in delta.tool_calls or []:
+                    call = calls.setdefault(
+                        part.index, {"id": "", "type": "function", "function": {"name": "", "arguments": ""}}
+                    )
+                    if part.id:
+                        call["id"] = part.id
+                    if part.function:
+                        call["function"]["name"] += part.function.name or ""
+                        call["function"]["arguments"] += part.function.arguments or ""
+                    if on_tool_call and part.index not in dispatched and self._complete_call(call):
+                        dispatched.add(part.index)
+                        started.append(on_tool_call(ChatCompletionMessageToolCall.model_validate(call)))
+        except BaseException:
+            for handle in started:
+                if hasattr(handle, "cancel"):
+                    handle.cancel()
             raise
+        if content or reasoning:
+            on_token("\n")
+        if not content and not calls:
+            return None
+
+        text = "".join(content)
+        if usage:
+            self.update_token_count(usage.prompt_tokens, usage.completion_tokens)
+        else:
+            # the endpoint sent no usage, estimate it
+            completion_tokens = self.count_tokens(text + "".join(reasoning)) + sum(
+                self.count_tokens(c["function"]["name"] + c["function"]["arguments"]) for c in calls.values()
+            )
+            self.update_token_count(input_tokens, completion_tokens)
+
+        message = {"role": "assistant", "content": text or None}
+        if calls:
+            message["tool_calls"] = [calls[i] for i in sorted(calls)]
+        if reasoning:
+            message["reasoning_content"] = "".join(reasoning)
+        return ChatCompletionMessage.model_validate(message)
+
+    @staticmethod
+    def _replay_tool_response(
+        message: ChatCompletionMessage,
+        on_token: Optional[Callable[[str], None]] = None,
+        on_tool_call: Optional[Callable[[ChatCompletionMessageToolCall], Any]] = None,
+    ) -> None:
+        """Feed a cached message to the streaming callbacks as if it had just been streamed"""
+        on_token = on_token or (lambda text: print(text, end="", flush=True))
+        if message.content:
+            on_token(message.content)
+            on_token("\n")
+        if on_tool_call:
+            for call in message.tool_calls or []:
+                on_tool_call(call)
+
+    @staticmethod
+    def _complete_call(call: dict) -> bool:
+        arguments = call["function"]["arguments"].rstrip()
+        if not (call["id"] and call["function"]["name"] and arguments.endswith("}")):
+            return False
+        try:
+            return isinstance(json.loads(arguments), dict)
+        except ValueError:
+            return False
 
     async def get_embedding(
         self,
         content: str,
         timeout: int = 60
-    ) -> str:
+    ) -> bytes:
+        """Embedding of `content` as raw float32 bytes.
+
+        Concurrent calls are batched: requests arriving within
+        `embedding_batch_window` seconds (or until `embedding_batch_size` are
+        queued) share one embeddings API call, and a content already being
+        embedded is not requested again.
+        """
+        # tokens never outnumber UTF-8 bytes, only long contents need counting
+        if len(content.encode()) > self.llm_config.embedding_max_tokens:
+            content = self.truncate_text(content, self.llm_config.embedding_max_tokens)
+        cache = self.embedding_cache
+        if cache:
+            embedding = cache.get(content)
+            if embedding is not None:
+                return embedding
+        embedding, _ = await self._single_flight(
+            ("embedding", content), lambda: self._send_embedding(content, timeout)
+        )
+        return embedding
+
+    async def _send_embedding(self, content: str, timeout: int) -> bytes:
+        """Embedding of one content, through the batch if batching is enabled"""
+        cache = self.embedding_cache
+        if self.llm_config.embedding_batch_size > 1:
+            loop = asyncio.get_running_loop()
+            if loop is not self._embedding_loop:
+                self._rebind_embedding_batch(loop)
+            future = loop.create_future()
+            self._embedding_batch.append((content, timeout, future))
+            if len(self._embedding_batch) >= self.llm_config.embedding_batch_size:
+                self._flush_embedding_batch()
+            elif self._embedding_flush is None:
+                self._embedding_flush = loop.call_later(
+                    self.llm_config.embedding_batch_window, self._flush_embedding_batch
+                )
+            embedding = await future
+        else:
+            embedding = (await self._create_embeddings([content], timeout))[0]
+        if cache and embedding:
+            cache.put(content, embedding)
+            logger.debug(f"Embedding cache: {cache.stats()}")
+        return embedding
+
+    def _rebind_embedding_batch(self, loop: asyncio.AbstractEventLoop) -> None:
+        """Start a new batch on `loop`: the timer and futures of the previous loop died with it"""
+        if self._embedding_batch:
+            logger.debug(f"Dropped {len(self._embedding_batch)} embeddings batched on a finished event loop")
+        self._embedding_batch = []
+        self._embedding_flush = None
+        self._embedding_tasks = set()
+        self._embedding_loop = loop
+
+    def _flush_embedding_batch(self) -> None:
+        if self._embedding_flush is not None:
+            self._embedding_flush.cancel()
+            self._embedding_flush = None
+        batch, self._embedding_batch = self._embedding_batch, []
+        if batch:
+            task = asyncio.ensure_future(self._send_embedding_batch(batch))
+            self._embedding_tasks.add(task)
+            task.add_done_callback(self._embedding_tasks.discard)
+
+    async def _send_embedding_batch(self, batch: List[tuple]) -> None:
+        """One API call for the whole batch, results fanned out to the waiting futures"""
+        contents = list(dict.fromkeys(content for content, _, _ in batch))
         try:
-            response = await self.client.embeddings.create(
-                model=self.model,
-                input=content,
-                encoding_format="float",
-                timeout=timeout
-            )
-            return str(response.data[0].embedding)
+            by_content = await self._embed_split(contents, max(timeout for _, timeout, _ in batch))
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for content, _, future in batch:
+            if future.done():
+                continue
+            result = by_content[content]
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+        logger.debug(f"Embedded {len(contents)} contents in one request")
+
+    async def _embed_split(self, contents: List[str], timeout: int) -> Dict[str, Union[bytes, Exception]]:
+        """Embeddings by content. A batch the API rejects as a bad request is split
+        in halves until the inputs at fault fail alone, the others still get embedded."""
+        try:
+            return dict(zip(contents, await self._create_embeddings(contents, timeout)))
+        except BadRequestError as e:
+            if len(contents) == 1:
+                return {contents[0]: e}
+        middle = len(contents) // 2
+        left, right = await asyncio.gather(
+            self._embed_split(contents[:middle], timeout), self._embed_split(contents[middle:], timeout)
+        )
+        return {**left, **right}
+
+    async def _create_embeddings(self, contents: List[str], timeout: int = 60) -> List[bytes]:
+        try:
+            tokens = sum(map(self.count_tokens, contents)) if self.rate_limiter.counts_tokens else 0
+            async with self._rate_limited(tokens):
+                response = await self.client.embeddings.create(
+                    model=self.model,
+                    input=contents,
+                    encoding_format="float",
+                    timeout=timeout
+                )
+            data = sorted(response.data, key=lambda d: d.index)
+            return [encode_embedding(d.embedding) or b"" for d in data]
         except ValueError as ve:
-            logger.error(f"Validation error in ask_tool: {ve}")
+            logger.error(f"Validation error in get_embedding: {ve}")
             raise
         except OpenAIError as oe:
             logger.error(f"OpenAI API error: {oe}")
@@ -834,7 +1285,7 @@ class LLM:
                 logger.error(f"API error: {oe}")
             raise
         except Exception as e:
-            logger.error(f"Unexpected error in ask_tool: {e}")
+            logger.error(f"Unexpected error in get_embedding: {e}")
             raise
 
 llm_embeddings: LLM = LLM("embeddings")
@@ -0,0 +1,30 @@
+from app.memory.ann import IVFIndex
+from app.memory.compaction import format_episode, group_episodes
+from app.memory.matrix import (
+    EmbeddingMatrix,
+    as_vector,
+    decode_embedding,
+    encode_embedding,
+)
+from app.memory.pipeline import EmbeddingPipeline
+from app.memory.rank import mmr, reciprocal_rank_fusion, time_decay
+from app.memory.sidecar import EmbeddingSidecar, SidecarLocked
+from app.memory.store import MessageStore
+
+
+__all__ = [
+    "EmbeddingPipeline",
+    "EmbeddingMatrix",
+    "EmbeddingSidecar",
+    "IVFIndex",
+    "MessageStore",
+    "SidecarLocked",
+    "as_vector",
+    "decode_embedding",
+    "encode_embedding",
+    "format_episode",
+    "group_episodes",
+    "mmr",
+    "reciprocal_rank_fusion",
+    "time_decay",
+]
@@ -0,0 +1,226 @@
+import threading
+from os import path
+from typing import Optional, Tuple
+
+import numpy as np
+
+from app.logger import logger
+from app.memory.matrix import EmbeddingLike, EmbeddingMatrix, as_vector, dequantize, quantize, quantized_dot
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    k = min(k, scores.shape[0])
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    idx = np.argpartition(-scores, k - 1)[:k] if k < scores.shape[0] else np.arange(k)
+    return idx[np.argsort(-scores[idx], kind="stable")]
+
+
+def assign_clusters(vectors: np.ndarray, centroids: np.ndarray, chunk: int = 16384) -> np.ndarray:
+    """Nearest centroid of every vector, chunked to bound the score matrix size"""
+    assign = np.empty(vectors.shape[0], dtype=np.int64)
+    for start in range(0, vectors.shape[0], chunk):
+        assign[start : start + chunk] = np.argmax(vectors[start : start + chunk] @ centroids.T, axis=1)
+    return assign
+
+
+def kmeans(vectors: np.ndarray, n_clusters: int, n_iter: int = 10, seed: int = 0) -> np.ndarray:
+    """Spherical k-means on normalized vectors, returns normalized centroids"""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(vectors.shape[0], n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        assign = assign_clusters(vectors, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, vectors)
+        empty = ~np.any(sums, axis=1)
+        # re-seed empty clusters with random points
+        sums[empty] = vectors[rng.choice(vectors.shape[0], int(empty.sum()))]
+        centroids = _normalize(sums)
+    return centroids
+
+
+class IVFIndex:
+    """Inverted-file ANN index over message embeddings, pure NumPy.
+
+    Trained vectors are kept normalized and grouped by their nearest centroid
+    (CSR layout), a query only scans the `nprobe` closest lists. Vectors added
+    after training go to a small exhaustive `pending` tail, once that tail grows
+    past `rebuild_ratio` of the trained size the index is retrained in a
+    background thread. Ids are message times. Posting list vectors can be
+    stored as float16 or per-row scaled int8 (`dtype`). `dirty` tells whether
+    anything changed since the index was last saved or loaded.
+    """
+
+    TRAIN_SAMPLES_PER_LIST = 32
+
+    def __init__(
+        self,
+        nlist: int = 0,
+        nprobe: int = 8,
+        rebuild_ratio: float = 0.2,
+        min_size: int = 10000,
+        dtype: str = "float32",
+    ):
+        self.nlist = nlist
+        self.dtype = dtype
+        self.nprobe = nprobe
+        self.rebuild_ratio = rebuild_ratio
+        self.min_size = min_size
+        self.centroids: Optional[np.ndarray] = None
+        self._ids = np.zeros(0, dtype=np.int64)
+        self._vectors = np.zeros((0, 0), dtype=dtype)
+        self._scales = np.zeros(0, dtype=np.float32)
+        self._offsets = np.zeros(1, dtype=np.int64)
+        self.pending = EmbeddingMatrix()
+        self.max_id = -1
+        self.dirty = False
+        self._lock = threading.Lock()
+        self._building: Optional[threading.Thread] = None
+
+    def __len__(self) -> int:
+        return self._ids.shape[0] + self.pending.size
+
+    @property
+    def trained(self) -> bool:
+        return self.centroids is not None
+
+    @property
+    def stale(self) -> bool:
+        if not self.trained:
+            return len(self) >= self.min_size
+        return self.pending.size > self.rebuild_ratio * max(self._ids.shape[0], 1)
+
+    def add(self, key: int, embeddings: EmbeddingLike) -> None:
+        vec = as_vector(embeddings)
+        if vec is None:
+            return
+        with self._lock:
+            self.pending.append(key, vec)
+            self.max_id = max(self.max_id, key)
+            self.dirty = True
+
+    def _snapshot(self) -> Tuple[np.ndarray, np.ndarray, int]:
+        with self._lock:
+            n_pending = self.pending.size
+            trained = dequantize(self._vectors, self._scales)
+            if not n_pending:
+                return self._ids, trained, 0
+            ids = np.concatenate([self._ids, self.pending.keys[:n_pending]])
+            pending = _normalize(self.pending.vectors.copy())
+            vectors = np.concatenate([trained, pending]) if self._ids.shape[0] else pending
+        return ids, vectors, n_pending
+
+    def build(self) -> None:
+        """(Re)train centroids and posting lists over everything added so far"""
+        ids, vectors, n_pending = self._snapshot()
+        if not ids.shape[0]:
+            return
+        nlist = self.nlist or max(1, int(np.sqrt(ids.shape[0])))
+        nlist = min(nlist, ids.shape[0])
+        rng = np.random.default_rng(0)
+        n_train = min(ids.shape[0], nlist * self.TRAIN_SAMPLES_PER_LIST)
+        sample = vectors[rng.choice(ids.shape[0], n_train, replace=False)]
+        centroids = kmeans(sample, nlist)
+        assign = assign_clusters(vectors, centroids)
+        order = np.argsort(assign, kind="stable")
+        offsets = np.zeros(nlist + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assign, minlength=nlist), out=offsets[1:])
+        rows, scales = quantize(vectors[order], self.dtype)
+        with self._lock:
+            self.centroids = centroids
+            self._ids = ids[order]
+            self._vectors, self._scales = np.ascontiguousarray(rows), scales
+            self._offsets = offsets
+            # vectors added while building stay in the pending tail
+            self.pending.drop_front(n_pending)
+            self.dirty = True
+
+    def _build_job(self) -> None:
+        try:
+            self.build()
+            logger.info(f"ANN index rebuilt: {len(self)} vectors, recall@10={self.measure_recall():.3f}")
+        except Exception as e:
+            logger.error(f"ANN index rebuild failed: {e}")
+
+    def maybe_rebuild(self) -> None:
+        """Start a background rebuild when the index is stale"""
+        if not self.stale or (self._building and self._building.is_alive()):
+            return
+        self._building = threading.Thread(target=self._build_job, daemon=True)
+        self._building.start()
+
+    def search(self, query: EmbeddingLike, k: int, nprobe: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """(ids, scores) of the approximate k nearest vectors by cosine, best first"""
+        q = as_vector(query)
+        if q is None or not len(self):
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        q = _normalize(q)
+        with self._lock:
+            ids, scores = [], []
+            if self.trained and q.shape[0] == self.centroids.shape[1]:
+                probes = _top_k(self.centroids @ q, nprobe or self.nprobe)
+                for c in probes:
+                    start, end = self._offsets[c], self._offsets[c + 1]
+                    ids.append(self._ids[start:end])
+                    scores.append(quantized_dot(self._vectors[start:end], self._scales[start:end], q))
+            if self.pending.size:
+                ids.append(self.pending.keys[: self.pending.size].copy())
+                scores.append(self.pending.scores(q))
+        if not ids:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        ids, scores = np.concatenate(ids), np.concatenate(scores)
+        top = _top_k(scores, k)
+        return ids[top], scores[top]
+
+    def measure_recall(self, k: int = 10, n_queries: int = 50, nprobe: Optional[int] = None) -> float:
+        """recall@k of `search` against a brute-force scan, using stored vectors as queries"""
+        ids, vectors, _ = self._snapshot()
+        if not ids.shape[0]:
+            return 1.0
+        rng = np.random.default_rng(0)
+        queries = rng.choice(ids.shape[0], min(n_queries, ids.shape[0]), replace=False)
+        hits = 0
+        for qi in queries:
+            exact = ids[_top_k(vectors @ vectors[qi], k)]
+            approx, _ = self.search(vectors[qi], k, nprobe)
+            hits += np.intersect1d(exact, approx).shape[0]
+        return hits / (len(queries) * min(k, ids.shape[0]))
+
+    def save(self, file: str) -> None:
+        """Write the index to `file`, unless nothing changed since it was last saved or loaded"""
+        with self._lock:
+            if not self.dirty:
+                return
+            np.savez(
+                file,
+                centroids=self.centroids if self.trained else np.zeros((0, 0), dtype=np.float32),
+                ids=self._ids,
+                vectors=self._vectors,
+                scales=self._scales,
+                offsets=self._offsets,
+                pending_ids=self.pending.keys[: self.pending.size],
+                pending_vectors=self.pending.vectors,
+            )
+            self.dirty = False
+
+    def load(self, file: str) -> bool:
+        if not path.exists(file):
+            return False
+        with np.load(file) as data:
+            self.centroids = data["centroids"] if data["centroids"].size else None
+            self._ids = data["ids"]
+            self._vectors = data["vectors"]
+            self._scales = data["scales"] if "scales" in data else np.ones(self._ids.shape[0], dtype=np.float32)
+            self._offsets = data["offsets"]
+            self.pending = EmbeddingMatrix()
+            for key, vec in zip(data["pending_ids"], data["pending_vectors"]):
+                self.pending.append(int(key), vec)
+        ids = np.concatenate([self._ids, self.pending.keys[: self.pending.size]])
+        self.max_id = int(ids.max()) if ids.shape[0] else -1
+        self.dirty = False
+        return True
@@ -0,0 +1,135 @@
+"""Memory benchmarks, run with `python -m app.memory.bench [quantization|history]`"""
+import argparse
+import gc
+import multiprocessing
+import resource
+import sys
+import time
+from typing import Dict, List
+
+import numpy as np
+
+from app.memory.matrix import QUANT_DTYPES, EmbeddingMatrix, encode_embedding
+
+
+def _clustered_vectors(rng: np.random.Generator, n: int, dim: int) -> np.ndarray:
+    # clustered data ranks more like real embeddings than isotropic noise
+    centers = rng.standard_normal((max(n // 100, 1), dim))
+    vectors = centers[rng.integers(centers.shape[0], size=n)] + 0.5 * rng.standard_normal((n, dim))
+    return vectors.astype(np.float32)
+
+
+def benchmark_quantization(
+    n: int = 5000,
+    dim: int = 1536,
+    k: int = 10,
+    n_queries: int = 20,
+    rerank_factor: int = 4,
+    seed: int = 0,
+) -> List[Dict[str, float]]:
+    """Memory and recall@k of every index dtype against the float32 `embeddings_similarity` ranking"""
+    from app.schema import embeddings_similarity  # app.schema imports this package
+
+    rng = np.random.default_rng(seed)
+    vectors = _clustered_vectors(rng, n, dim)
+    blobs = [encode_embedding(v) for v in vectors]
+    queries = vectors[rng.choice(n, n_queries, replace=False)]
+    queries = queries + 0.1 * rng.standard_normal(queries.shape).astype(np.float32)
+    exact = []
+    for q in queries:
+        blob = encode_embedding(q)
+        scores = np.array([embeddings_similarity(blob, b) for b in blobs])
+        exact.append(np.argsort(-scores, kind="stable")[:k])
+
+    norms = np.linalg.norm(vectors, axis=1)
+    results = []
+    for dtype in QUANT_DTYPES:
+        matrix = EmbeddingMatrix(dim, capacity=n, dtype=dtype)
+        for i, v in enumerate(vectors):
+            matrix.append(i, v)
+        hits = rerank_hits = 0
+        start = time.perf_counter()
+        for q, truth in zip(queries, exact):
+            rows, _ = matrix.search(q, k * rerank_factor)
+            hits += np.intersect1d(rows[:k], truth).shape[0]
+            cosine = vectors[rows] @ q / (norms[rows] * np.linalg.norm(q))
+            reranked = rows[np.argsort(-cosine, kind="stable")[:k]]
+            rerank_hits += np.intersect1d(reranked, truth).shape[0]
+        elapsed = time.perf_counter() - start
+        results.append(
+            {
+                "dtype": dtype,
+                "bytes": matrix.nbytes,
+                "recall": hits / (n_queries * k),
+                "recall_rerank": rerank_hits / (n_queries * k),
+                "ms_per_query": elapsed * 1000 / n_queries,
+            }
+        )
+    baseline = results[0]["bytes"]
+    for r in results:
+        r["saved"] = 1 - r["bytes"] / baseline
+    return results
+
+
+def _rss_bytes() -> int:
+    # peak RSS, which only grows while the history is being built
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _history_rss(kind: str, n: int, content_len: int) -> int:
+    """RSS growth of holding n history rows as `kind`, run in a fresh process"""
+    from app.schema import Message, MessageRecord
+
+    cls = {"Message": Message, "MessageRecord": MessageRecord}[kind]
+    text = "x" * content_len
+    gc.collect()
+    before = _rss_bytes()
+    history = [
+        cls(role=("user", "assistant")[i % 2], time=i + 1, content=text[:-8] + f"{i:08d}",
+            tokens=content_len // 4)
+        for i in range(n)
+    ]
+    gc.collect()
+    grown = _rss_bytes() - before
+    del history
+    return grown
+
+
+def benchmark_history_memory(n: int = 100_000, content_len: int = 200) -> List[Dict[str, float]]:
+    """RSS per `n` in-memory messages, as pydantic Message and as slotted MessageRecord.
+
+    Embeddings are left out, their bytes cost the same in both.
+    """
+    results = []
+    ctx = multiprocessing.get_context("spawn")
+    for kind in ("Message", "MessageRecord"):
+        with ctx.Pool(1) as pool:
+            rss = pool.apply(_history_rss, (kind, n, content_len))
+        results.append({"kind": kind, "rss": rss, "per_message": rss / n})
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("benchmark", nargs="?", choices=["quantization", "history"], default="quantization")
+    parser.add_argument("-n", type=int, default=0, help="number of stored vectors / messages")
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=20)
+    parser.add_argument("--rerank-factor", type=int, default=4)
+    parser.add_argument("--content-len", type=int, default=200, help="characters per message")
+    args = parser.parse_args()
+    if args.benchmark == "history":
+        n = args.n or 100_000
+        print(f"{'kind':<14} {'MB/' + str(n):>10} {'B/message':>10}")
+        for r in benchmark_history_memory(n, args.content_len):
+            print(f"{r['kind']:<14} {r['rss'] / 2**20:>10.1f} {r['per_message']:>10.0f}")
+        sys.exit()
+    args.n = args.n or 5000
+    print(f"{'dtype':<8} {'MB':>8} {'saved':>6} {'recall@' + str(args.k):>10} {'+rerank':>8} {'ms/query':>9}")
+    for r in benchmark_quantization(args.n, args.dim, args.k, args.queries, args.rerank_factor):
+        print(
+            f"{r['dtype']:<8} {r['bytes'] / 2**20:>8.2f} {r['saved']:>6.0%} "
+            f"{r['recall']:>10.3f} {r['recall_rerank']:>8.3f} {r['ms_per_query']:>9.2f}"
+        )
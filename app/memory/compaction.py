@@ -0,0 +1,66 @@
+from datetime import datetime
+from typing import List, Sequence
+
+# rough tokens per character for messages whose count was never stored
+CHARS_PER_TOKEN = 4
+# an episode this many times over its limits breaks without waiting for a user message
+OVERFLOW_FACTOR = 2
+
+
+def _tokens(message) -> int:
+    return message.tokens or len(message.content or "") // CHARS_PER_TOKEN + 4
+
+
+def group_episodes(
+    messages: Sequence,
+    gap: float = 1800,
+    max_messages: int = 60,
+    max_tokens: int = 6000,
+) -> List[list]:
+    """Split time-ordered messages into episodes for summarization.
+
+    An episode ends at a silence longer than `gap` seconds, or once it holds
+    `max_messages` messages or `max_tokens` tokens. Episodes break before a
+    user message; a run without one (active checks, long tool chains) is cut
+    once it is `OVERFLOW_FACTOR` times over a limit, before the next message
+    that is not a tool result, so a tool call always stays with its results.
+    Messages need `time` (ms), `role`, `content`, `tool_calls` and `tokens`
+    attributes.
+
+    The last episode is left out: it may go on past the end of `messages`.
+    """
+    episodes: List[list] = []
+    current: list = []
+    tokens = 0
+    for m in messages:
+        if current and (
+            m.role == "user" and (
+                m.time - current[-1].time > gap * 1000
+                or len(current) >= max_messages
+                or tokens >= max_tokens
+            )
+            or m.role != "tool" and not current[-1].tool_calls and (
+                len(current) >= OVERFLOW_FACTOR * max_messages
+                or tokens >= OVERFLOW_FACTOR * max_tokens
+            )
+        ):
+            episodes.append(current)
+            current, tokens = [], 0
+        current.append(m)
+        tokens += _tokens(m)
+    return episodes
+
+
+def format_episode(messages: Sequence, max_chars: int = 2000) -> str:
+    """Plain-text transcript of an episode for the summarizer, long messages cut to `max_chars`"""
+    lines = []
+    for m in messages:
+        content = (m.content or "").strip()
+        if not content:
+            continue
+        if len(content) > max_chars:
+            content = content[:max_chars] + "..."
+        speaker = f"{m.role}({m.name})" if getattr(m, "name", None) else m.role
+        when = datetime.fromtimestamp(m.time / 1000.0).strftime("%Y-%m-%d %H:%M")
+        lines.append(f"[{when}] {speaker}: {content}")
+    return "\n".join(lines)
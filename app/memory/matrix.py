@@ -0,0 +1,205 @@
+import json
+from typing import Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+
+EmbeddingLike = Union[str, bytes, Sequence[float], np.ndarray, None]
+QUANT_DTYPES = ("float32", "float16", "int8")
+
+
+def encode_embedding(embeddings: EmbeddingLike, dtype: str = "float32") -> Optional[bytes]:
+    """Pack an embedding into a raw BLOB of the given dtype, None if it is empty"""
+    vec = as_vector(embeddings)
+    return None if vec is None else vec.astype(dtype).tobytes()
+
+
+def decode_embedding(blob: Optional[bytes], dtype: str = "float32") -> Optional[np.ndarray]:
+    """Unpack a raw BLOB written by `encode_embedding` into a float32 vector"""
+    if not blob:
+        return None
+    return np.frombuffer(blob, dtype=dtype).astype(np.float32, copy=False)
+
+
+def as_vector(embeddings: EmbeddingLike) -> Optional[np.ndarray]:
+    """Convert an embedding into a float32 vector, None if it is empty.
+
+    bytes are raw float32, str is the legacy JSON text format.
+    """
+    if embeddings is None:
+        return None
+    if isinstance(embeddings, (bytes, bytearray, memoryview)):
+        return decode_embedding(bytes(embeddings))
+    if isinstance(embeddings, str):
+        embeddings = json.loads(embeddings) if embeddings else []
+    vec = np.asarray(embeddings, dtype=np.float32).ravel()
+    return vec if vec.size else None
+
+
+def quantize(vectors: np.ndarray, dtype: str = "float32") -> Tuple[np.ndarray, np.ndarray]:
+    """(rows in `dtype`, per-row scales), int8 rows are scaled so their largest component is 127"""
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    scales = np.ones(vectors.shape[0], dtype=np.float32)
+    if dtype == "int8":
+        peak = np.abs(vectors).max(axis=1) if vectors.shape[1] else scales * 0
+        scales = np.where(peak > 0, peak / 127, 1).astype(np.float32)
+        return np.rint(vectors / scales[:, None]).astype(np.int8), scales
+    return vectors.astype(dtype), scales
+
+
+def dequantize(rows: np.ndarray, scales: np.ndarray) -> np.ndarray:
+    if rows.dtype == np.float32:
+        return rows
+    vectors = rows.astype(np.float32)
+    if rows.dtype == np.int8:
+        vectors *= scales[:, None]
+    return vectors
+
+
+def quantized_dot(rows: np.ndarray, scales: np.ndarray, query: np.ndarray, chunk: int = 8192) -> np.ndarray:
+    """rows @ query for float32/float16/int8 rows.
+
+    Narrow rows are widened one chunk at a time so the product still runs on
+    BLAS while the float32 copy stays bounded.
+    """
+    if rows.dtype == np.float32:
+        return rows @ query
+    dots = np.empty(rows.shape[0], dtype=np.float32)
+    for start in range(0, rows.shape[0], chunk):
+        dots[start : start + chunk] = rows[start : start + chunk].astype(np.float32) @ query
+    if rows.dtype == np.int8:
+        dots *= scales
+    return dots
+
+
+class EmbeddingMatrix:
+    """In-process embedding matrix with precomputed norms.
+
+    Rows are contiguous float32 and stay aligned with the owner's message list,
+    `keys` holds the message time of every row. Rows without embedding are kept
+    as zeros and score 0, the same as `embeddings_similarity` does.
+
+    Rows can be stored as float16 or per-row scaled int8 (`dtype`), norms are
+    taken from the float32 input so only the dot products are approximate.
+    """
+
+    def __init__(self, dim: int = 0, capacity: int = 256, dtype: str = "float32"):
+        self.dim = dim
+        self.dtype = dtype
+        self.size = 0
+        self.keys = np.zeros(capacity, dtype=np.int64)
+        self._data = np.zeros((capacity, dim), dtype=dtype)
+        self._scales = np.ones(capacity, dtype=np.float32)
+        self._norms = np.zeros(capacity, dtype=np.float32)
+
+    def __len__(self) -> int:
+        return self.size
+
+    @property
+    def capacity(self) -> int:
+        return self.keys.shape[0]
+
+    @property
+    def vectors(self) -> np.ndarray:
+        """float32 rows (dequantized copy unless stored as float32)"""
+        return dequantize(self._data[: self.size], self._scales[: self.size])
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes held by the rows in use"""
+        per_row = self.keys.itemsize + self._norms.itemsize + self._data.itemsize * self.dim
+        if self.dtype == "int8":
+            per_row += self._scales.itemsize
+        return self.size * per_row
+
+    @property
+    def norms(self) -> np.ndarray:
+        return self._norms[: self.size]
+
+    def _reserve(self, n: int):
+        if n <= self.capacity:
+            return
+        capacity = max(n, self.capacity * 2)
+        keys = np.zeros(capacity, dtype=np.int64)
+        keys[: self.size] = self.keys[: self.size]
+        data = np.zeros((capacity, self.dim), dtype=self.dtype)
+        data[: self.size] = self._data[: self.size]
+        scales = np.ones(capacity, dtype=np.float32)
+        scales[: self.size] = self._scales[: self.size]
+        norms = np.zeros(capacity, dtype=np.float32)
+        norms[: self.size] = self._norms[: self.size]
+        self.keys, self._data, self._scales, self._norms = keys, data, scales, norms
+
+    def _set_dim(self, dim: int):
+        # the dimension is only known once the first embedding arrives
+        if self.dim == dim:
+            return
+        if self.dim and np.any(self._norms[: self.size]):
+            raise ValueError(f"embedding dimension mismatch: {dim} != {self.dim}")
+        self.dim = dim
+        self._data = np.zeros((self.capacity, dim), dtype=self.dtype)
+
+    def append(self, key: int, embeddings: EmbeddingLike = None) -> int:
+        """Append one row and return its index"""
+        self._reserve(self.size + 1)
+        row = self.size
+        self.keys[row] = key
+        self.size += 1
+        self.set_row(row, embeddings)
+        return row
+
+    def set_row(self, row: int, embeddings: EmbeddingLike):
+        vec = as_vector(embeddings)
+        if vec is None:
+            if self.dim:
+                self._data[row] = 0
+            self._norms[row] = 0
+            return
+        self._set_dim(vec.shape[0])
+        rows, scales = quantize(vec, self.dtype)
+        self._data[row], self._scales[row] = rows[0], scales[0]
+        self._norms[row] = np.linalg.norm(vec)
+
+    def drop_front(self, n: int):
+        """Drop the n oldest rows, used when the message list is trimmed"""
+        n = min(n, self.size)
+        if n <= 0:
+            return
+        remain = self.size - n
+        self.keys[:remain] = self.keys[n : self.size]
+        self._data[:remain] = self._data[n : self.size]
+        self._scales[:remain] = self._scales[n : self.size]
+        self._norms[:remain] = self._norms[n : self.size]
+        self.size = remain
+
+    def clear(self):
+        self.size = 0
+
+    def scores(self, query: EmbeddingLike) -> np.ndarray:
+        """Cosine similarity of every row against the query"""
+        q = as_vector(query)
+        if q is None or not self.size or q.shape[0] != self.dim:
+            return np.zeros(self.size, dtype=np.float32)
+        q_norm = np.linalg.norm(q)
+        if not q_norm:
+            return np.zeros(self.size, dtype=np.float32)
+        dots = quantized_dot(self._data[: self.size], self._scales[: self.size], q)
+        denom = self.norms * q_norm
+        return np.divide(dots, denom, out=np.zeros_like(dots), where=denom > 0)
+
+    def search(self, query: EmbeddingLike, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """(row indices, scores) of the k most similar rows, best first"""
+        k = min(k, self.size)
+        if k <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        scores = self.scores(query)
+        if k < self.size:
+            idx = np.argpartition(-scores, k - 1)[:k]
+        else:
+            idx = np.arange(self.size)
+        idx = idx[np.argsort(-scores[idx], kind="stable")]
+        return idx, scores[idx]
+
+    def top_k(self, query: EmbeddingLike, k: int) -> np.ndarray:
+        """Row indices of the k most similar rows, best first"""
+        return self.search(query, k)[0]
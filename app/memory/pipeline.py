@@ -0,0 +1,147 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, Hashable, Optional
+
+from app.logger import logger
+
+# seconds `flush` waits by default, a stuck API call must not hang shutdown
+FLUSH_TIMEOUT = 30.0
+
+
+class EmbeddingPipeline:
+    """Bounded background queue that embeds message contents off the agent loop.
+
+    `submit` returns as soon as the item is queued (it only blocks while the
+    queue is full). Workers take up to `batch_size` queued items at a time and
+    embed them concurrently, so the LLM batching layer sends them as one
+    request. Failed items are retried with exponential backoff, results are
+    handed to `on_result(key, embeddings)`. Keys identify the message, e.g.
+    its time, or (session, time) when several memories share the pipeline.
+
+    The queue and workers belong to the event loop that runs them. When the
+    pipeline is used from a new loop (e.g. a new `asyncio.run` per GUI rerun)
+    they are rebuilt there, and the work the old loop left is queued again.
+    """
+
+    def __init__(
+        self,
+        embed: Callable[[str], Awaitable[bytes]],
+        on_result: Callable[[Hashable, bytes], None],
+        workers: int = 2,
+        max_queue: int = 256,
+        batch_size: int = 64,
+        retries: int = 3,
+        retry_delay: float = 0.5,
+    ):
+        self.embed = embed
+        self.on_result = on_result
+        self.n_workers = workers
+        self.batch_size = batch_size
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.queue: asyncio.Queue = asyncio.Queue(max_queue)
+        self.pending: Dict[Hashable, asyncio.Future] = {}
+        # items a worker has taken but not finished, requeued if their loop ends
+        self._active: Dict[Hashable, str] = {}
+        self._workers = []
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+    def _start(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._rebind(loop)
+        # a worker only ends if something killed it, replace it
+        self._workers = [w for w in self._workers if not w.done()]
+        while len(self._workers) < self.n_workers:
+            self._workers.append(asyncio.create_task(self._work()))
+
+    def _rebind(self, loop: asyncio.AbstractEventLoop) -> None:
+        """Move to `loop`: workers and futures of the previous loop died with it"""
+        items = list(self._active.items())
+        while not self.queue.empty():
+            items.append(self.queue.get_nowait())
+        items = list(dict(items).items())
+        self.queue = asyncio.Queue(max(self.queue.maxsize, len(items)) if self.queue.maxsize else 0)
+        for item in items:
+            self.queue.put_nowait(item)
+        self.pending = {key: loop.create_future() for key, _ in items}
+        self._active = {}
+        self._workers = []
+        self._loop = loop
+        if items:
+            logger.debug(f"Requeued {len(items)} embeddings left by a finished event loop")
+
+    async def submit(self, key: Hashable, content: str) -> None:
+        """Queue `content` for embedding, its result is stored under `key`"""
+        self._start()
+        if key not in self.pending:
+            self.pending[key] = asyncio.get_running_loop().create_future()
+        await self.queue.put((key, content))
+
+    async def wait(self, key: Hashable, timeout: Optional[float] = None) -> Optional[bytes]:
+        """Embedding of a pending key, None if it is not ready within `timeout` seconds"""
+        self._start()
+        future = self.pending.get(key)
+        if future is None:
+            return None
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except Exception:
+            return None
+
+    async def flush(self, timeout: Optional[float] = FLUSH_TIMEOUT) -> bool:
+        """Wait for all queued work, False if it did not finish within `timeout` seconds (None waits forever)"""
+        if self._loop is None:
+            return True
+        self._start()
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            logger.warning(f"{len(self.pending)} embeddings still pending")
+            return False
+
+    async def close(self, timeout: Optional[float] = FLUSH_TIMEOUT) -> None:
+        await self.flush(timeout)
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def _work(self) -> None:
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            self._active.update(batch)
+            try:
+                await asyncio.gather(*(self._embed_one(key, content) for key, content in batch))
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    async def _embed_one(self, key: Hashable, content: str) -> None:
+        future = self.pending.get(key)
+        for attempt in range(self.retries + 1):
+            try:
+                embeddings = await self.embed(content)
+                self.on_result(key, embeddings)
+                if future is not None and not future.done():
+                    future.set_result(embeddings)
+                break
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if attempt == self.retries:
+                    logger.error(f"Embedding message {key} failed after {attempt + 1} attempts: {e}")
+                    if future is not None and not future.done():
+                        future.set_exception(e)
+                        # nobody may wait for it, keep the loop from warning about it
+                        future.exception()
+                    break
+                await asyncio.sleep(self.retry_delay * 2**attempt)
+        if self.pending.get(key) is future:
+            self.pending.pop(key, None)
+        self._active.pop(key, None)
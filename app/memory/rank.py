@@ -0,0 +1,53 @@
+from typing import Dict, Hashable, List, Optional, Sequence
+
+import numpy as np
+
+
+def reciprocal_rank_fusion(
+    rankings: Sequence[Sequence[Hashable]],
+    k: int = 60,
+    weights: Optional[Sequence[float]] = None,
+) -> List[Hashable]:
+    """Fuse ranked lists into one, scoring each item `sum(weight / (k + rank))`.
+
+    Only ranks are used, so scores on different scales (BM25, cosine) fuse
+    without normalization. Ties keep the order of first appearance.
+    """
+    weights = weights or [1.0] * len(rankings)
+    scores: Dict[Hashable, float] = {}
+    for ranking, weight in zip(rankings, weights):
+        for rank, item in enumerate(ranking, start=1):
+            scores[item] = scores.get(item, 0.0) + weight / (k + rank)
+    return sorted(scores, key=scores.get, reverse=True)
+
+
+def time_decay(times: Sequence[float], now: float, half_life: float) -> np.ndarray:
+    """Recency weight `0.5 ** (age / half_life)` of every time, 1 for `now` and later; times and half-life in one unit"""
+    age = np.maximum(now - np.asarray(times, dtype=np.float64), 0.0)
+    if half_life <= 0:
+        return np.ones_like(age)
+    return np.exp2(-age / half_life)
+
+
+def mmr(relevance: Sequence[float], vectors: np.ndarray, n: int, lambda_: float = 0.7) -> List[int]:
+    """Maximal marginal relevance: greedily pick n indices by `lambda * relevance - (1 - lambda) * redundancy`.
+
+    Redundancy is the highest cosine similarity to an item already picked
+    (rows of `vectors`, zero rows are similar to nothing), so a near-duplicate
+    of a pick loses to a less relevant item that adds something new.
+    """
+    relevance = np.asarray(relevance, dtype=np.float64)
+    n = min(n, relevance.shape[0])
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    unit = vectors / np.where(norms > 0, norms, 1)
+    similarity = unit @ unit.T
+    redundancy = np.zeros_like(relevance)
+    picked: List[int] = []
+    available = np.ones(relevance.shape[0], dtype=bool)
+    for _ in range(n):
+        scores = np.where(available, lambda_ * relevance - (1 - lambda_) * redundancy, -np.inf)
+        i = int(np.argmax(scores))
+        picked.append(i)
+        available[i] = False
+        redundancy = np.maximum(redundancy, similarity[i])
+    return picked
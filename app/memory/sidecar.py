@@ -0,0 +1,293 @@
+import os
+import struct
+from os import path
+from typing import Dict, Iterable, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows, no advisory locks
+    fcntl = None
+
+import numpy as np
+
+from app.memory.matrix import EmbeddingLike, as_vector, dequantize, quantize, quantized_dot
+
+
+class SidecarLocked(RuntimeError):
+    """Another process holds the sidecar open for writing"""
+
+
+class EmbeddingSidecar:
+    """Embedding rows in a memory-mapped file next to the memory db.
+
+    Layout: a fixed header (magic, dim, row count, deleted rows, max time, dtype)
+    followed by rows of `[time:int64][norm:float32][scale:float32][vector:dtype * dim]`,
+    vectors are float32, float16 or per-row scaled int8 (see `quantize`).
+    Opening only maps the file, vectors are scored straight from the page cache,
+    and processes mapping the same file (`readonly=True` plus `refresh`) share
+    those pages.
+
+    The header count only moves forward in `flush`, after the rows themselves
+    are synced, so rows past it (torn by a crash) are ignored on reopen and the
+    owner re-appends them from the db. Re-appending an existing time leaves a
+    tombstone (norm 0) behind, `compact` rewrites the file without them.
+
+    One process writes a sidecar at a time: a writable instance holds an
+    exclusive lock on `<file>.lock` (POSIX only) until `close`, opening a
+    second one raises `SidecarLocked`, other processes open it `readonly`.
+    """
+
+    MAGIC = b"NHDEMB02"
+    # files written before the dtype field have zero padding there, which reads as float32
+    HEADER = struct.Struct("<8sIQQqB")
+    HEADER_SIZE = 64
+    META_BYTES = 16  # time, norm, scale
+    DTYPES = ("float32", "float16", "int8")
+    MIN_CAPACITY = 1024
+
+    def __init__(self, file: str, dim: int = 0, readonly: bool = False, dtype: str = "float32"):
+        """An existing file keeps the dtype it was written with, see `dtype`"""
+        self.file = file
+        self.dim = dim
+        self.dtype = dtype
+        self.size = 0
+        self.deleted = 0
+        self.max_key = -1
+        self.readonly = readonly
+        self._mm: Optional[np.memmap] = None
+        self._inode = None
+        # row of the live entry of every key, built on the first out-of-order append
+        self._rows: Optional[Dict[int, int]] = None
+        self._lock_file = None
+        if not readonly:
+            self._lock()
+        if path.exists(file) and path.getsize(file) >= self.HEADER_SIZE:
+            self._open()
+
+    def __len__(self) -> int:
+        return self.size
+
+    def _lock(self) -> None:
+        if fcntl is None:
+            return
+        if path.dirname(self.file):
+            os.makedirs(path.dirname(self.file), exist_ok=True)
+        self._lock_file = open(f"{self.file}.lock", "a+b")
+        try:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self._lock_file.close()
+            self._lock_file = None
+            raise SidecarLocked(f"{self.file} is opened for writing by another process")
+
+    def _unlock(self) -> None:
+        if self._lock_file is not None:
+            # closing the file releases the lock
+            self._lock_file.close()
+            self._lock_file = None
+
+    def _row_of(self, key: int) -> Optional[int]:
+        """Row of the live entry of `key`, if it has one"""
+        if key > self.max_key:
+            # appends in time order, the common case, never need the map
+            return None
+        if self._rows is None:
+            live = np.flatnonzero(self.norms > 0)
+            self._rows = dict(zip(self.keys[live].tolist(), live.tolist()))
+        return self._rows.get(key)
+
+    def _read_header(self) -> Tuple[int, int, int, int, str]:
+        with open(self.file, "rb") as f:
+            magic, dim, size, deleted, max_key, dtype = self.HEADER.unpack(f.read(self.HEADER.size))
+        if magic != self.MAGIC:
+            raise ValueError(f"{self.file} is not an embedding sidecar")
+        return dim, size, deleted, max_key, self.DTYPES[dtype]
+
+    def _pack_header(self, size: int, deleted: int, max_key: int) -> bytes:
+        header = self.HEADER.pack(self.MAGIC, self.dim, size, deleted, max_key, self.DTYPES.index(self.dtype))
+        return header.ljust(self.HEADER_SIZE, b"\0")
+
+    def _open(self) -> None:
+        self.dim, size, self.deleted, self.max_key, self.dtype = self._read_header()
+        self._map()
+        if size > self.capacity:
+            # the header count is past the file end, the file was cut short
+            self.size = self.capacity
+            self.max_key = self.max_key_of_rows()
+        else:
+            self.size = size
+
+    @property
+    def row_bytes(self) -> int:
+        # padded to whole float32 words, the layout of float32 rows is unchanged
+        vec_bytes = self.dim * np.dtype(self.dtype).itemsize
+        return self.META_BYTES + (vec_bytes + 3) // 4 * 4
+
+    @property
+    def capacity(self) -> int:
+        return self._mm.shape[0] if self._mm is not None else 0
+
+    def _column(self, start: int, dtype) -> np.ndarray:
+        if not self.size:
+            return np.zeros(0, dtype=dtype)
+        return self._mm[: self.size, start : start + np.dtype(dtype).itemsize].view(dtype)[:, 0]
+
+    @property
+    def keys(self) -> np.ndarray:
+        return self._column(0, np.int64)
+
+    @property
+    def norms(self) -> np.ndarray:
+        return self._column(8, np.float32)
+
+    @property
+    def scales(self) -> np.ndarray:
+        return self._column(12, np.float32)
+
+    @property
+    def rows(self) -> np.ndarray:
+        """Stored (possibly quantized) vectors, no copy"""
+        if not self.size:
+            return np.zeros((0, self.dim), dtype=self.dtype)
+        end = self.META_BYTES + self.dim * np.dtype(self.dtype).itemsize
+        return self._mm[: self.size, self.META_BYTES : end].view(self.dtype)
+
+    @property
+    def vectors(self) -> np.ndarray:
+        return dequantize(self.rows, self.scales)
+
+    def max_key_of_rows(self) -> int:
+        return int(self.keys.max()) if self.size else -1
+
+    def newer_than(self, after: int) -> Tuple[np.ndarray, np.ndarray]:
+        """(keys, vectors) of the live rows with time greater than `after`"""
+        idx = np.flatnonzero((self.keys > after) & (self.norms > 0))
+        return self.keys[idx], dequantize(self.rows[idx], self.scales[idx])
+
+    def _map(self) -> None:
+        self._inode = os.stat(self.file).st_ino
+        capacity = (path.getsize(self.file) - self.HEADER_SIZE) // self.row_bytes if self.dim else 0
+        self._mm = (
+            np.memmap(
+                self.file,
+                dtype=np.uint8,
+                mode="r" if self.readonly else "r+",
+                offset=self.HEADER_SIZE,
+                shape=(capacity, self.row_bytes),
+            )
+            if capacity
+            else None
+        )
+
+    def refresh(self) -> None:
+        """Pick up rows flushed (or a compaction done) by the writing process"""
+        if not path.exists(self.file):
+            return
+        dim, size, deleted, max_key, dtype = self._read_header()
+        if os.stat(self.file).st_ino != self._inode or size > self.capacity or dim != self.dim or dtype != self.dtype:
+            self.dim, self.dtype = dim, dtype
+            self._map()
+        self.size, self.deleted, self.max_key = min(size, self.capacity), deleted, max_key
+
+    def _write_header(self) -> None:
+        with open(self.file, "r+b") as f:
+            f.write(self._pack_header(self.size, self.deleted, self.max_key))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _reserve(self, n: int) -> None:
+        if n <= self.capacity:
+            return
+        capacity = max(n, self.capacity * 2, self.MIN_CAPACITY)
+        if self._mm is not None:
+            self._mm.flush()
+            self._mm = None
+        mode = "r+b" if path.exists(self.file) else "w+b"
+        with open(self.file, mode) as f:
+            f.truncate(self.HEADER_SIZE + capacity * self.row_bytes)
+            if mode == "w+b":
+                f.write(self._pack_header(0, 0, -1))
+        self._map()
+
+    def append(self, key: int, embeddings: EmbeddingLike) -> bool:
+        """Append one row, rows without embedding are skipped"""
+        if self.readonly:
+            raise PermissionError(f"{self.file} is opened read-only")
+        vec = as_vector(embeddings)
+        if vec is None:
+            return False
+        if not self.dim:
+            self.dim = vec.shape[0]
+        elif vec.shape[0] != self.dim:
+            raise ValueError(f"embedding dimension mismatch: {vec.shape[0]} != {self.dim}")
+        old = self._row_of(key)
+        if old is not None:
+            # re-embedded message, the newest row wins
+            self._mm[old, 8:12].view(np.float32)[0] = 0
+            self.deleted += 1
+        self._reserve(self.size + 1)
+        row = self._mm[self.size]
+        rows, scales = quantize(vec, self.dtype)
+        row[0:8].view(np.int64)[0] = key
+        row[8:16].view(np.float32)[:] = np.linalg.norm(vec), scales[0]
+        row[self.META_BYTES : self.META_BYTES + rows.nbytes] = rows.view(np.uint8).ravel()
+        if self._rows is not None:
+            self._rows[key] = self.size
+        self.size += 1
+        self.max_key = max(self.max_key, key)
+        return True
+
+    def flush(self) -> None:
+        """Sync rows, then publish the new row count in the header"""
+        if self._mm is not None and not self.readonly:
+            self._mm.flush()
+            self._write_header()
+
+    def close(self) -> None:
+        self.flush()
+        self._mm = None
+        self._unlock()
+
+    def compact(self, keep: Optional[Iterable[int]] = None) -> int:
+        """Rewrite the file without tombstones (and rows whose time is not in `keep`), returns rows dropped"""
+        if self.readonly or not self.size:
+            return 0
+        mask = self.norms > 0
+        if keep is not None:
+            mask &= np.isin(self.keys, np.fromiter(keep, dtype=np.int64))
+        dropped = int(self.size - mask.sum())
+        if not dropped:
+            return 0
+        rows = np.asarray(self._mm[: self.size][mask])
+        keys = rows[:, :8].copy().view(np.int64)[:, 0]
+        rows = rows[np.argsort(keys, kind="stable")]
+        max_key = int(keys.max()) if keys.shape[0] else -1
+        tmp = f"{self.file}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(self._pack_header(rows.shape[0], 0, max_key))
+            f.write(rows.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        self._mm = None
+        os.replace(tmp, self.file)
+        self.size, self.deleted, self.max_key = rows.shape[0], 0, max_key
+        self._map()
+        self._rows = None
+        return dropped
+
+    def search(self, query: EmbeddingLike, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """(keys, scores) of the k rows with the highest cosine similarity, best first"""
+        q = as_vector(query)
+        if q is None or not self.size or q.shape[0] != self.dim or not np.linalg.norm(q):
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        dots = quantized_dot(self.rows, self.scales, q)
+        denom = self.norms * np.linalg.norm(q)
+        live = denom > 0
+        # tombstones score below every live row and are never returned
+        scores = np.divide(dots, denom, out=np.full_like(dots, -np.inf), where=live)
+        k = min(k, int(live.sum()))
+        if k <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        idx = np.argpartition(-scores, k - 1)[:k] if k < self.size else np.arange(self.size)
+        idx = idx[np.argsort(-scores[idx], kind="stable")]
+        return self.keys[idx], scores[idx]
@@ -0,0 +1,297 @@
+import re
+import sqlite3
+import threading
+from os import makedirs, path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from app.logger import logger
+from app.memory.matrix import as_vector, decode_embedding, encode_embedding
+
+
+# same layout pydantic_sqlite used, so existing db files open unchanged
+MESSAGE_TABLE = """CREATE TABLE IF NOT EXISTS [Message] (
+    [role] TEXT, [time] INTEGER PRIMARY KEY, [embeddings] BLOB, [content] TEXT,
+    [tool_calls] TEXT, [name] TEXT, [tool_call_id] TEXT, [base64_image] TEXT
+)"""
+# columns added since, appended to older db files on open
+MESSAGE_COLUMNS = {"tokens": "INTEGER"}
+# rows still waiting for their embedding (it failed, or was queued when the process ended)
+UNEMBEDDED_INDEX = (
+    "CREATE INDEX IF NOT EXISTS Message_unembedded ON Message (time) WHERE embeddings IS NULL AND content != ''"
+)
+EMBEDDING_META_TABLE = "CREATE TABLE IF NOT EXISTS EmbeddingMeta (key TEXT PRIMARY KEY, value TEXT)"
+# rolling summaries of compacted episodes, keyed by the time of the episode's last message;
+# the source messages are the Message rows with start <= time <= end
+SUMMARY_TABLE = """CREATE TABLE IF NOT EXISTS [Summary] (
+    [time] INTEGER PRIMARY KEY, [start] INTEGER, [end] INTEGER, [content] TEXT,
+    [embeddings] BLOB, [tokens] INTEGER
+)"""
+# full-text index over {table}.content (external content, rowid = time), kept in sync by triggers.
+# The default unicode61 tokenizer takes a whole CJK run for one token, so the
+# indexed text is segmented first: every CJK run becomes its overlapping bigrams.
+FTS_TABLE = "CREATE VIRTUAL TABLE {table}FTS USING fts5(content, content='{table}', content_rowid='time')"
+FTS_TRIGGERS = [
+    """CREATE TRIGGER IF NOT EXISTS {table}_fts_insert AFTER INSERT ON {table} BEGIN
+        INSERT INTO {table}FTS (rowid, content) VALUES (new.time, segment_cjk(new.content));
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS {table}_fts_delete AFTER DELETE ON {table} BEGIN
+        INSERT INTO {table}FTS ({table}FTS, rowid, content) VALUES ('delete', old.time, segment_cjk(old.content));
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS {table}_fts_update AFTER UPDATE OF content ON {table} BEGIN
+        INSERT INTO {table}FTS ({table}FTS, rowid, content) VALUES ('delete', old.time, segment_cjk(old.content));
+        INSERT INTO {table}FTS (rowid, content) VALUES (new.time, segment_cjk(new.content));
+    END""",
+]
+FTS_TRIGGER_NAMES = ("{table}_fts_insert", "{table}_fts_delete", "{table}_fts_update")
+FTS_SOURCES = ("Message", "Summary")
+FTS_MAX_TERMS = 32
+# kana, CJK ideographs and hangul
+CJK_RUN = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af]+")
+
+
+def _bigrams(match: re.Match) -> str:
+    run = match.group()
+    if len(run) == 1:
+        return f" {run} "
+    return " " + " ".join(run[i : i + 2] for i in range(len(run) - 1)) + " "
+
+
+def segment_cjk(text: Optional[str]) -> Optional[str]:
+    """`text` with every CJK run replaced by its overlapping bigrams, space separated"""
+    if not text:
+        return text
+    return CJK_RUN.sub(_bigrams, text)
+
+
+class MessageStore:
+    """Append-only SQLite persistence for Memory.
+
+    Every insert goes straight to the db file (WAL journal), commits are grouped:
+    the first insert of a batch schedules a commit `commit_interval` seconds
+    later, so a crash loses at most one batch and closing only commits the
+    current batch.
+
+    Message contents are also indexed in an FTS5 table for `search_text`, if
+    the SQLite build has FTS5 (`fts` is False otherwise). Summaries written
+    by compaction live in their own table and full-text index.
+    """
+
+    def __init__(self, file: str = "", commit_interval: float = 1.0):
+        self.file = file or ":memory:"
+        if file and path.dirname(file):
+            makedirs(path.dirname(file), exist_ok=True)
+        self.commit_interval = commit_interval
+        self.conn = sqlite3.connect(self.file, check_same_thread=False)
+        # used by the FTS triggers
+        self.conn.create_function("segment_cjk", 1, segment_cjk, deterministic=True)
+        self.conn.row_factory = sqlite3.Row
+        if file:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+        self._lock = threading.RLock()
+        self._dirty = 0
+        self._timer: Optional[threading.Timer] = None
+        with self._lock:
+            self.conn.execute(MESSAGE_TABLE)
+            self._add_columns()
+            self.conn.execute(UNEMBEDDED_INDEX)
+            self.conn.execute(EMBEDDING_META_TABLE)
+            self.conn.execute(SUMMARY_TABLE)
+            self.fts = self._init_fts()
+            self.conn.commit()
+
+    def _add_columns(self) -> None:
+        existing = {row[1] for row in self.conn.execute("PRAGMA table_info(Message)").fetchall()}
+        for name, kind in MESSAGE_COLUMNS.items():
+            if name not in existing:
+                self.conn.execute(f"ALTER TABLE Message ADD COLUMN [{name}] {kind}")
+
+    def _init_fts(self) -> bool:
+        # INSERT OR REPLACE only fires the delete trigger with recursive triggers on
+        self.conn.execute("PRAGMA recursive_triggers=ON")
+        try:
+            for table in FTS_SOURCES:
+                trigger = self.conn.execute(
+                    "SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = ?", (f"{table}_fts_insert",)
+                ).fetchone()
+                if trigger and "segment_cjk" not in trigger[0]:
+                    # indexed before CJK segmentation, build it again
+                    for name in FTS_TRIGGER_NAMES:
+                        self.conn.execute(f"DROP TRIGGER IF EXISTS {name.format(table=table)}")
+                    self.conn.execute(f"DROP TABLE IF EXISTS {table}FTS")
+                exists = self.conn.execute(
+                    "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (f"{table}FTS",)
+                ).fetchone()
+                if not exists:
+                    self.conn.execute(FTS_TABLE.format(table=table))
+                    # index the rows written before the FTS table existed
+                    self.conn.execute(
+                        f"INSERT INTO {table}FTS (rowid, content) SELECT time, segment_cjk(content) FROM {table}"
+                    )
+                for trigger in FTS_TRIGGERS:
+                    self.conn.execute(trigger.format(table=table))
+        except sqlite3.OperationalError as e:
+            logger.warning(f"Full-text search unavailable: {e}")
+            return False
+        return True
+
+    def execute(self, sql: str, params=()) -> sqlite3.Cursor:
+        with self._lock:
+            return self.conn.execute(sql, params)
+
+    def rows(self, where: str = "", params=(), order: str = "time", limit: Optional[int] = None) -> Iterator[dict]:
+        sql = f"SELECT * FROM Message {'WHERE ' + where if where else ''} ORDER BY {order}"
+        if limit is not None:
+            sql, params = sql + " LIMIT ?", (*params, limit)
+        with self._lock:
+            rows = self.conn.execute(sql, params).fetchall()
+        for row in rows:
+            yield dict(row)
+
+    def tail(self, limit: int, before: Optional[int] = None) -> List[dict]:
+        """The `limit` newest rows (older than `before` if given), in time order"""
+        where, params = ("WHERE time < ?", (before, limit)) if before is not None else ("", (limit,))
+        sql = f"SELECT * FROM (SELECT * FROM Message {where} ORDER BY time DESC LIMIT ?) ORDER BY time"
+        with self._lock:
+            return [dict(row) for row in self.conn.execute(sql, params).fetchall()]
+
+    def embeddings(self, after: int = -1, before: Optional[int] = None) -> Iterator[Tuple[int, bytes]]:
+        """(time, BLOB) of every stored embedding in the time range (after, before)"""
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT time, embeddings FROM Message WHERE time > ? AND time < ? AND embeddings IS NOT NULL ORDER BY time",
+                (after, before if before is not None else 2**63 - 1),
+            ).fetchall()
+        for time, blob in rows:
+            yield time, blob
+
+    def unembedded(self, limit: int) -> List[Tuple[int, str]]:
+        """(time, content) of the newest rows with content but no embedding, newest first"""
+        with self._lock:
+            return [tuple(row) for row in self.conn.execute(
+                "SELECT time, content FROM Message WHERE embeddings IS NULL AND content != '' ORDER BY time DESC LIMIT ?",
+                (limit,),
+            ).fetchall()]
+
+    def search_text(self, text: str, limit: int, table: str = "Message") -> List[Tuple[int, float]]:
+        """(time, bm25 score) of the rows of `table` best matching any word of `text`, best first"""
+        if not self.fts:
+            return []
+        # CJK words match as the bigrams they were indexed as
+        terms = list(dict.fromkeys(re.findall(r"\w+", segment_cjk(text) or "")))[:FTS_MAX_TERMS]
+        if not terms:
+            return []
+        query = " OR ".join('"' + term.replace('"', '""') + '"' for term in terms)
+        with self._lock:
+            rows = self.conn.execute(
+                f"SELECT rowid, bm25({table}FTS) FROM {table}FTS WHERE {table}FTS MATCH ? ORDER BY rank LIMIT ?",
+                (query, limit),
+            ).fetchall()
+        # bm25() is lower for better matches
+        return [(time, -score) for time, score in rows]
+
+    def get(self, time: int) -> Optional[dict]:
+        for row in self.rows("time = ?", (time,)):
+            return row
+        return None
+
+    def count(self) -> int:
+        return self.execute("SELECT COUNT(*) FROM Message").fetchone()[0]
+
+    def insert(self, row: dict) -> None:
+        """Upsert one message row, committed with the current batch"""
+        columns = ", ".join(f"[{k}]" for k in row)
+        marks = ", ".join("?" for _ in row)
+        with self._lock:
+            self.conn.execute(
+                f"INSERT OR REPLACE INTO Message ({columns}) VALUES ({marks})", tuple(row.values())
+            )
+            self._dirty += 1
+            self._schedule_commit()
+
+    def update_embeddings(self, time: int, blob: Optional[bytes]) -> None:
+        """Store an embedding computed after its row was inserted"""
+        with self._lock:
+            self.conn.execute("UPDATE Message SET embeddings = ? WHERE time = ?", (blob, time))
+            self._dirty += 1
+            self._schedule_commit()
+
+    def update_tokens(self, time: int, tokens: int) -> None:
+        """Store a token count computed after its row was inserted"""
+        with self._lock:
+            self.conn.execute("UPDATE Message SET tokens = ? WHERE time = ?", (tokens, time))
+            self._dirty += 1
+            self._schedule_commit()
+
+    def summaries(self) -> List[dict]:
+        """Every stored summary, in time order"""
+        with self._lock:
+            return [dict(row) for row in self.conn.execute("SELECT * FROM Summary ORDER BY time").fetchall()]
+
+    def insert_summary(self, row: dict) -> None:
+        """Upsert one summary row, committed with the current batch"""
+        columns = ", ".join(f"[{k}]" for k in row)
+        marks = ", ".join("?" for _ in row)
+        with self._lock:
+            self.conn.execute(
+                f"INSERT OR REPLACE INTO Summary ({columns}) VALUES ({marks})", tuple(row.values())
+            )
+            self._dirty += 1
+            self._schedule_commit()
+
+    def _schedule_commit(self) -> None:
+        if self.commit_interval <= 0:
+            self.commit()
+        elif self._timer is None:
+            self._timer = threading.Timer(self.commit_interval, self.commit)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def commit(self) -> None:
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if self._dirty:
+                self.conn.commit()
+                self._dirty = 0
+
+    def close(self) -> None:
+        self.commit()
+        with self._lock:
+            self.conn.close()
+
+    def meta(self) -> Dict[str, str]:
+        """dtype and dimension of the embedding BLOBs, recorded once per db"""
+        return {k: v for k, v in self.execute("SELECT key, value FROM EmbeddingMeta").fetchall()}
+
+    def set_meta(self, **meta) -> None:
+        with self._lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO EmbeddingMeta (key, value) VALUES (?, ?)",
+                [(k, str(v)) for k, v in meta.items()],
+            )
+            self.conn.commit()
+
+    def migrate_embeddings(self, dtype: str) -> int:
+        """One-shot conversion of JSON text embeddings (or another dtype) into raw BLOBs of `dtype`"""
+        meta = self.meta()
+        stored = meta.get("dtype", "float32")
+        dim = meta.get("dim")
+        if meta.get("format") == "blob" and stored == dtype:
+            return 0
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT time, embeddings FROM Message WHERE typeof(embeddings) = 'text' OR ?",
+                (stored != dtype,),
+            ).fetchall()
+            for time, embeddings in rows:
+                vec = as_vector(embeddings) if isinstance(embeddings, str) else decode_embedding(embeddings, stored)
+                if vec is not None:
+                    dim = vec.shape[0]
+                self.conn.execute(
+                    "UPDATE Message SET embeddings = ? WHERE time = ?", (encode_embedding(vec, dtype), time)
+                )
+            self.conn.commit()
+        self.set_meta(format="blob", dtype=dtype, **({"dim": dim} if dim else {}))
+        return len(rows)
@@ -0,0 +1,4 @@
+SUMMARY_PROMPT = """You compress old conversation history into memory notes.
+Summarize the conversation excerpt you are given in the language it is written in, in at most 200 words.
+Keep facts that may matter later: names, preferences, decisions, promises, dates, numbers, file paths and results of tool calls.
+Leave out greetings, small talk and the wording of the messages. Reply with the summary only."""
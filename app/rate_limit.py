@@ -0,0 +1,139 @@
+import asyncio
+import time
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+
+class TokenBucket:
+    """Holds up to `per_minute` units, refilled continuously at `per_minute / 60` a second.
+
+    The level may go negative when usage is charged after the fact, later
+    takers then wait until the debt is refilled.
+    """
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until `amount` can be taken, a request larger than the bucket needs it full"""
+        self.refill()
+        missing = min(amount, self.capacity) - self.level
+        return max(missing, 0.0) / self.rate
+
+    def take(self, amount: float) -> None:
+        self.refill()
+        self.level -= amount
+
+
+class RateLimiter:
+    """Admission control for one LLM config: requests and tokens per minute, requests in flight.
+
+    `acquire` waits until the request fits every limit, so requests go out at
+    the provider's pace instead of failing with 429 and backing off. Callers
+    are admitted in arrival order. A limit of 0 is no limit.
+
+    The buckets outlive event loops, the asyncio primitives are made anew for
+    every loop that uses the limiter (the GUI runs a new loop per rerun).
+    """
+
+    def __init__(self, requests_per_minute: int = 0, tokens_per_minute: int = 0, max_in_flight: int = 0):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute > 0 else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute > 0 else None
+        self.max_in_flight = max_in_flight
+        self.in_flight: Optional[asyncio.Semaphore] = None
+        self.blocked_until = 0.0
+        self._turn: Optional[asyncio.Lock] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.requests or self.tokens or self.max_in_flight > 0)
+
+    @property
+    def counts_tokens(self) -> bool:
+        return self.tokens is not None
+
+    async def acquire(self, tokens: int = 0) -> None:
+        """Wait for a slot for one request estimated at `tokens` tokens, pair with `release`"""
+        self._bind()
+        if self.in_flight:
+            await self.in_flight.acquire()
+        try:
+            async with self._turn:
+                while True:
+                    wait = self.blocked_until - time.monotonic()
+                    if self.requests:
+                        wait = max(wait, self.requests.wait_time(1))
+                    if self.tokens:
+                        wait = max(wait, self.tokens.wait_time(tokens))
+                    if wait <= 0:
+                        break
+                    await asyncio.sleep(wait)
+                if self.requests:
+                    self.requests.take(1)
+                if self.tokens:
+                    self.tokens.take(tokens)
+        except BaseException:
+            if self.in_flight:
+                self.in_flight.release()
+            raise
+
+    def _bind(self) -> None:
+        """Primitives for the running loop, those of a finished loop cannot be awaited here"""
+        loop = asyncio.get_running_loop()
+        if loop is self._loop:
+            return
+        self.in_flight = asyncio.Semaphore(self.max_in_flight) if self.max_in_flight > 0 else None
+        self._turn = asyncio.Lock()
+        self._loop = loop
+
+    def release(self) -> None:
+        if self.in_flight:
+            self.in_flight.release()
+
+    def charge(self, tokens: int) -> None:
+        """Count tokens known only after the response, e.g. the completion"""
+        if self.tokens and tokens:
+            self.tokens.take(tokens)
+
+    def pause(self, seconds: float) -> None:
+        """Admit nothing for `seconds`, as the provider asked with Retry-After"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        # the provider's window is spent, do not burst again once the pause ends
+        for bucket in (self.requests, self.tokens):
+            if bucket:
+                bucket.refill()
+                bucket.level = min(bucket.level, 0.0)
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """Seconds to wait from the Retry-After headers of an API error's response, if it has any"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000.0
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
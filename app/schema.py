@@ -1,13 +1,37 @@
+import bisect
+import copy
+import hashlib
+import re
 from enum import Enum
-from typing import Any, List, Literal, Optional, Union
+from typing import Any, Dict, Iterable, Iterator, List, Literal, Optional, Set, Tuple, Union
 
 from pydantic import BaseModel, Field, field_validator
-from pydantic_sqlite import DataBase
 from datetime import datetime
 import numpy as np
-from os import path
+from os import path, remove
 import json
 
+from app.logger import logger
+from app.cache import LRUCache
+from app.config import MemorySettings, config
+from app.memory import (
+    EmbeddingMatrix,
+    EmbeddingSidecar,
+    IVFIndex,
+    MessageStore,
+    SidecarLocked,
+    as_vector,
+    decode_embedding,
+    encode_embedding,
+    group_episodes,
+    mmr,
+    reciprocal_rank_fusion,
+    time_decay,
+)
+
+# `name` of the Message records that stand for an episode summary
+SUMMARY_NAME = "summary"
+
 
 class Role(str, Enum):
     """Message role options"""
@@ -20,6 +44,8 @@ class Role(str, Enum):
 
 ROLE_VALUES = tuple(role.value for role in Role)
 ROLE_TYPE = Literal[ROLE_VALUES]  # type: ignore
+# one shared string per role for the records in memory
+ROLE_INTERN = {v: v for v in ROLE_VALUES}
 
 
 class ToolChoice(str, Enum):
@@ -69,10 +95,13 @@ class ToolCall(BaseModel):
         def convert(obj):
             return ToolCall.model_dump_json(obj)
 
-def embeddings_similarity(a: list, b: list):
-    a = json.loads(a)
-    b = json.loads(b)
-    if not a or not b:
+def memory_settings() -> MemorySettings:
+    return config.memory_config or MemorySettings()
+
+def embeddings_similarity(a: bytes, b: bytes):
+    a = as_vector(a)
+    b = as_vector(b)
+    if a is None or b is None:
         return 0.
     return np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
 
@@ -90,8 +119,17 @@ class Message(BaseModel):
     name: Optional[str] = Field(default=None)
     tool_call_id: Optional[str] = Field(default=None)
     base64_image: Optional[str] = Field(default=None)
-    embeddings: Optional[str] = Field(default="[]") # [str(float)]
+    embeddings: bytes = Field(default=b"") # raw float32
     time: int = Field(default=0)
+    tokens: Optional[int] = Field(default=None)  # token count, stored with the row once counted
+
+    @field_validator('embeddings', mode="before")
+    @classmethod
+    def validate_embeddings(cls, v):
+        if isinstance(v, bytes):
+            return v
+        # legacy JSON text, list or ndarray
+        return encode_embedding(v) or b""
 
     @field_validator('tool_calls', mode="before")
     @classmethod
@@ -105,27 +143,24 @@ class Message(BaseModel):
         if isinstance(v, str):
             return [json.loads(_t) for _t in json.loads(v)]
 
-    def __add__(self, other) -> List["Message"]:
+    def __add__(self, other) -> "MessageList":
         """支持 Message + list 或 Message + Message 的操作"""
-        if isinstance(other, list):
-            if self.time in [m.time for m in other]:
+        if isinstance(other, (list, Message)):
+            other = other if isinstance(other, MessageList) else MessageList(
+                [other] if isinstance(other, Message) else other)
+            if self in other:
                 return other
-            return [self] + other
-        elif isinstance(other, Message):
-            if other.time == self.time:
-                return [self]
-            return [self, other]
+            return MessageList([self]) + other
         else:
             raise TypeError(
                 f"unsupported operand type(s) for +: '{type(self).__name__}' and '{type(other).__name__}'"
             )
 
-    def __radd__(self, other) -> List["Message"]:
+    def __radd__(self, other) -> "MessageList":
         """支持 list + Message 的操作"""
         if isinstance(other, list):
-            if self.time in [m.time for m in other]:
-                return other
-            return other + [self]
+            other = other if isinstance(other, MessageList) else MessageList(other)
+            return other + self
         else:
             raise TypeError(
                 f"unsupported operand type(s) for +: '{type(other).__name__}' and '{type(self).__name__}'"
@@ -163,7 +198,19 @@ class Message(BaseModel):
 
     @property
     def sqlite_repr(self):
-        return self.to_dict(all=True)
+        """Row of the Message table, tool_calls kept in the pydantic_sqlite JSON layout"""
+        return {
+            "role": self.role,
+            "time": self.time,
+            "embeddings": encode_embedding(self.embeddings, memory_settings().embedding_dtype),
+            "content": self.content,
+            "tool_calls": json.dumps([ToolCall.SQConfig.convert(t) for t in self.tool_calls])
+            if self.tool_calls is not None else None,
+            "name": self.name,
+            "tool_call_id": self.tool_call_id,
+            "base64_image": self.base64_image,
+            "tokens": self.tokens,
+        }
 
     @classmethod
     def user_message(
@@ -225,106 +272,845 @@ class Message(BaseModel):
         )
 
 
+class MessageRecord:
+    """Slotted in-memory form of a stored Message, what `Memory.messages` holds.
+
+    A pydantic Message carries a `__dict__`, the fields-set bookkeeping and
+    parsed ToolCall models; a record is one fixed-size object per message, the
+    role is a shared string and tool calls stay in their stored JSON until
+    read. Records read like a Message (same attribute names) and are
+    converted with `to_message` where a real Message is needed, e.g. before
+    the LLM call.
+    """
+
+    __slots__ = ("role", "time", "content", "_tool_calls", "name", "tool_call_id",
+                 "base64_image", "embeddings", "tokens")
+
+    def __init__(self, role: str, time: int = 0, content: Optional[str] = None,
+                 tool_calls: Optional[str] = None, name: Optional[str] = None,
+                 tool_call_id: Optional[str] = None, base64_image: Optional[str] = None,
+                 embeddings: bytes = b"", tokens: Optional[int] = None):
+        self.role = ROLE_INTERN.get(role, role)
+        self.time = time
+        self.content = content
+        self._tool_calls = tool_calls  # JSON text in the Message table layout
+        self.name = name
+        self.tool_call_id = tool_call_id
+        self.base64_image = base64_image
+        self.embeddings = embeddings
+        self.tokens = tokens
+
+    @classmethod
+    def of(cls, message: Union[Message, "MessageRecord"]) -> "MessageRecord":
+        if isinstance(message, MessageRecord):
+            return message
+        row = message.sqlite_repr
+        row["embeddings"] = message.embeddings
+        return cls(**row)
+
+    @property
+    def tool_calls(self) -> Optional[List[ToolCall]]:
+        if self._tool_calls is None:
+            return None
+        return [ToolCall.model_validate_json(t) for t in json.loads(self._tool_calls)]
+
+    def to_message(self) -> Message:
+        return Message(
+            role=self.role,
+            time=self.time,
+            content=self.content,
+            tool_calls=self.tool_calls,
+            name=self.name,
+            tool_call_id=self.tool_call_id,
+            base64_image=self.base64_image,
+            embeddings=self.embeddings,
+            tokens=self.tokens,
+        )
+
+    def to_dict(self, all: bool = False) -> dict:
+        """Same dict as `Message.to_dict`, without building the Message"""
+        if all:
+            message = {"role": self.role, "time": self.time, "embeddings": self.embeddings}
+        else:
+            message = {"role": self.role}
+        if self.content is not None:
+            message["content"] = self.content
+        if self._tool_calls is not None:
+            message["tool_calls"] = [json.loads(t) for t in json.loads(self._tool_calls)]
+        if self.name is not None:
+            message["name"] = self.name
+        if self.tool_call_id is not None:
+            message["tool_call_id"] = self.tool_call_id
+        if self.base64_image is not None:
+            message["base64_image"] = self.base64_image
+        return message
+
+    def __str__(self) -> str:
+        return str(self.to_message())
+
+    def __repr__(self) -> str:
+        return f"MessageRecord({self.role}, time={self.time})"
+
+
+def as_message(message: Union[Message, MessageRecord]) -> Message:
+    return message.to_message() if isinstance(message, MessageRecord) else message
+
+
+class MessageList(list):
+    """List of messages kept unique by `time`, with O(1) append, concat and `in`.
+
+    A message whose time is already present is skipped. Unsaved messages
+    (time 0) have no identity yet and are always kept. It is still a plain
+    list to `LLM.format_messages` and Memory.
+    """
+
+    def __init__(self, messages: Iterable[Message] = ()):
+        super().__init__()
+        self._times: Set[int] = set()
+        self.extend(messages)
+
+    def _reindex(self) -> None:
+        self._times = {m.time for m in self if m.time}
+
+    def has_time(self, time: int) -> bool:
+        return time in self._times
+
+    def __contains__(self, message) -> bool:
+        if isinstance(message, (Message, MessageRecord)) and message.time:
+            return message.time in self._times
+        return super().__contains__(message)
+
+    def append(self, message: Message) -> None:
+        if message.time:
+            if message.time in self._times:
+                return
+            self._times.add(message.time)
+        super().append(message)
+
+    def extend(self, messages: Iterable[Message]) -> None:
+        for m in messages:
+            self.append(m)
+
+    def insert(self, index: int, message: Message) -> None:
+        if message.time:
+            if message.time in self._times:
+                return
+            self._times.add(message.time)
+        super().insert(index, message)
+
+    def __add__(self, other) -> "MessageList":
+        result = MessageList(self)
+        result += other
+        return result
+
+    def __radd__(self, other) -> "MessageList":
+        if not isinstance(other, (list, Message)):
+            return NotImplemented
+        result = MessageList([other] if isinstance(other, Message) else other)
+        result.extend(self)
+        return result
+
+    def __iadd__(self, other) -> "MessageList":
+        if isinstance(other, Message):
+            self.append(other)
+        elif isinstance(other, list):
+            self.extend(other)
+        else:
+            return NotImplemented
+        return self
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return MessageList(super().__getitem__(index))
+        return super().__getitem__(index)
+
+    def __setitem__(self, index, value) -> None:
+        super().__setitem__(index, value)
+        self._reindex()
+
+    def __delitem__(self, index) -> None:
+        super().__delitem__(index)
+        self._reindex()
+
+    def pop(self, index: int = -1) -> Message:
+        message = super().pop(index)
+        self._times.discard(message.time)
+        return message
+
+    def remove(self, message: Message) -> None:
+        super().remove(message)
+        self._times.discard(message.time)
+
+    def clear(self) -> None:
+        super().clear()
+        self._times.clear()
+
+    def copy(self) -> "MessageList":
+        return MessageList(self)
+
+    # the default list protocols restore `_times` before re-adding the items,
+    # which would then all be skipped as duplicates
+    def __copy__(self) -> "MessageList":
+        return MessageList(self)
+
+    def __deepcopy__(self, memo) -> "MessageList":
+        result = MessageList()
+        memo[id(self)] = result
+        result.extend(copy.deepcopy(m, memo) for m in self)
+        return result
+
+    def __reduce_ex__(self, protocol):
+        return MessageList, (list(self),)
+
+
+class TurnIndex:
+    """Structural index over a message list, maintained on append.
+
+    Maps every tool_call_id to the position of the assistant message that made
+    the call, tracks calls still waiting for their result, and keeps the
+    positions of complete turn starts (non-tool messages whose tool calls are
+    all answered) in order. Positions are absolute, `offset` counts messages
+    dropped from the front, so trimming renumbers nothing.
+    """
+
+    def __init__(self, messages: Iterable[Message] = ()):
+        self.offset = 0
+        self.size = 0
+        self.calls: Dict[str, int] = {}
+        self.unanswered: Dict[int, Set[str]] = {}
+        self.turns: List[int] = []
+        for m in messages:
+            self.append(m)
+
+    def __len__(self) -> int:
+        return self.size - self.offset
+
+    def append(self, message: Message) -> None:
+        pos = self.size
+        self.size += 1
+        if message.role == Role.TOOL:
+            owner = self.calls.get(message.tool_call_id)
+            waiting = self.unanswered.get(owner)
+            if waiting is not None:
+                waiting.discard(message.tool_call_id)
+                if not waiting:
+                    del self.unanswered[owner]
+                    bisect.insort(self.turns, owner)
+            return
+        if message.tool_calls:
+            ids = {f.id for f in message.tool_calls}
+            for call_id in ids:
+                self.calls[call_id] = pos
+            self.unanswered[pos] = ids
+            return
+        self.turns.append(pos)
+
+    def drop_front(self, messages: List[Message]) -> None:
+        """Forget the given messages, the first `len(messages)` of the list"""
+        for pos, m in enumerate(messages, self.offset):
+            if m.tool_calls:
+                for f in m.tool_calls:
+                    if self.calls.get(f.id) == pos:
+                        del self.calls[f.id]
+                self.unanswered.pop(pos, None)
+        self.offset += len(messages)
+        del self.turns[: bisect.bisect_left(self.turns, self.offset)]
+
+    def _consistent(self, pos: int, message: Message, start: int) -> bool:
+        # unanswered calls and results whose call is not in the slice would be rejected by the API
+        if pos in self.unanswered:
+            return False
+        if message.role == Role.TOOL:
+            owner = self.calls.get(message.tool_call_id)
+            return owner is not None and owner >= start and owner not in self.unanswered
+        return True
+
+    def _slice(self, messages: List[Message], start: int, end: int) -> List[Message]:
+        return [
+            m
+            for pos, m in enumerate(messages[start - self.offset : end - self.offset], start)
+            if self._consistent(pos, m, start)
+        ]
+
+    def window(self, messages: List[Message], n: int) -> List[Message]:
+        """The last n - 1 complete turns of `messages` (the list this index was built on), tool pairs kept whole"""
+        if n <= 1 or not self.turns:
+            return []
+        start = self.turns[-(n - 1)] if len(self.turns) >= n - 1 else self.offset
+        return self._slice(messages, start, self.size)
+
+    def units(self, messages: List[Message]) -> Iterator[List[Message]]:
+        """Complete turns newest first, an assistant tool-call message with its results in one unit"""
+        end = self.size
+        for start in reversed(self.turns):
+            yield self._slice(messages, start, end)
+            end = start
+
+
 class Memory:
-    messages: List[Message] = []
+    """Conversation memory in two tiers.
+
+    The hot tier is the last `max_messages` messages in RAM (`messages` and the
+    `index` matrix). Older messages are only kept in the db. The embeddings of
+    every stored message live in the memory-mapped `sidecar`, so related-message
+    lookup covers the whole history while RAM stays bounded, and startup maps
+    the sidecar instead of reading embeddings back from the db.
+
+    Old episodes compacted into `summaries` are retrieved as one summary
+    instead of their raw turns.
+
+    All state is per instance, one Memory per db file; `MemoryShards` hands
+    out one per conversation.
+    """
+
+    messages: List[MessageRecord]
     max_messages: int = 100
     backend_db_file: str = ""
 
     def init(self, backend_db_file: str = ""):
-        if not hasattr(self, "db"):
-            self.db = DataBase(memory_name=backend_db_file)
+        settings = memory_settings()
+        self.backend_db_file = backend_db_file
+        self.messages = []
+        self.closed = False
+        self.db = MessageStore(backend_db_file, commit_interval=settings.commit_interval)
+        if self.db.migrate_embeddings(settings.embedding_dtype):
+            logger.info(f"Migrated message embeddings to {settings.embedding_dtype} BLOBs")
         if backend_db_file:
-            self.backend_db_file = backend_db_file
-            if path.exists(self.backend_db_file):
-                self.db.load(self.backend_db_file)
-                self.messages = [m for m in self.db("Message")]
+            rows = self.db.tail(settings.load_window) if settings.load_window else self.db.rows()
+            self.messages = [self._row_to_record(row) for row in rows]
+        self.max_messages = settings.hot_messages
+        self.index = EmbeddingMatrix(dtype=settings.index_dtype)
+        self.turns = TurnIndex()
+        self._by_time = {}
+        self.sidecar = self._init_sidecar()
+        self._sync_index()
+        self._trim()
+        self.ann = self._init_ann()
+        self._init_summaries()
 
     def __init__(self, **kwargs):
         self.init(**kwargs)
 
+    def _init_sidecar(self) -> Optional[EmbeddingSidecar]:
+        if not self.backend_db_file:
+            return None
+        settings = memory_settings()
+        try:
+            sidecar = EmbeddingSidecar(f"{self.backend_db_file}.emb", dtype=settings.index_dtype)
+        except SidecarLocked:
+            # another process owns the files, share its rows and only write the db
+            logger.warning(f"{self.backend_db_file} is in use by another process, embedding sidecar is read-only")
+            return EmbeddingSidecar(f"{self.backend_db_file}.emb", readonly=True)
+        if sidecar.dtype != settings.index_dtype:
+            # written with another index_dtype, rebuild it from the db
+            logger.info(f"Rebuilding embedding sidecar as {settings.index_dtype}")
+            sidecar.close()
+            remove(sidecar.file)
+            sidecar = EmbeddingSidecar(sidecar.file, dtype=settings.index_dtype)
+        # catch up with rows committed to the db after the sidecar was last flushed
+        for time, blob in self.db.embeddings(after=sidecar.max_key):
+            sidecar.append(time, decode_embedding(blob, settings.embedding_dtype))
+        sidecar.flush()
+        return sidecar
+
+    @property
+    def _shared(self) -> bool:
+        """Files owned by another process's Memory, this one only writes the db"""
+        return self.sidecar is not None and self.sidecar.readonly
+
+    def _sidecar_append(self, time: int, embeddings) -> None:
+        if self.sidecar is not None and not self.sidecar.readonly:
+            self.sidecar.append(time, embeddings)
+
+    def _trim(self) -> None:
+        """Move messages beyond `max_messages` from the hot tier to the cold tier"""
+        if len(self.messages) <= self.max_messages:
+            return
+        dropped = len(self.messages) - self.max_messages
+        for m in self.messages[:dropped]:
+            self._by_time.pop(m.time, None)
+        self.index.drop_front(dropped)
+        self.turns.drop_front(self.messages[:dropped])
+        self.messages = self.messages[-self.max_messages :]
+
+    @property
+    def _ann_file(self) -> str:
+        return f"{self.backend_db_file}.ann.npz"
+
+    def _init_ann(self) -> Optional[IVFIndex]:
+        settings = memory_settings()
+        if not settings.ann_enabled:
+            return None
+        ann = IVFIndex(
+            nlist=settings.ann_nlist,
+            nprobe=settings.ann_nprobe,
+            rebuild_ratio=settings.ann_rebuild_ratio,
+            min_size=settings.ann_min_size,
+            dtype=settings.index_dtype,
+        )
+        if self.backend_db_file:
+            ann.load(self._ann_file)
+        # catch up with rows written after the index was last saved
+        if self.sidecar is not None:
+            for time, vec in zip(*self.sidecar.newer_than(ann.max_id)):
+                ann.add(int(time), vec)
+        else:
+            for m in self.messages:
+                if m.time > ann.max_id:
+                    ann.add(m.time, m.embeddings)
+        ann.maybe_rebuild()
+        return ann
+
+    def _init_summaries(self) -> None:
+        self.summaries: List[Message] = []
+        self._summary_starts: List[int] = []
+        self._summary_by_time: Dict[int, Message] = {}
+        self.summary_index = EmbeddingMatrix(dtype=memory_settings().index_dtype)
+        for row in self.db.summaries():
+            self._add_summary_record(row.pop("start"), self._row_to_message(
+                {"role": Role.ASSISTANT, "name": SUMMARY_NAME, **{k: v for k, v in row.items() if k != "end"}}))
+
+    def _add_summary_record(self, start: int, summary: Message) -> None:
+        self.summaries.append(summary)
+        self._summary_starts.append(start)
+        self._summary_by_time[summary.time] = summary
+        self.summary_index.append(summary.time, summary.embeddings)
+
+    def summary_of(self, time: int) -> Optional[Message]:
+        """The summary whose episode holds the message at `time`, if it was compacted"""
+        i = bisect.bisect_left(self.summaries, time, key=lambda m: m.time)
+        if i < len(self.summaries) and self._summary_starts[i] <= time:
+            return self.summaries[i]
+        return None
+
+    def episodes_to_compact(self) -> List[List[Message]]:
+        """Next complete episodes after the last summary, never touching the `compaction_keep` newest messages"""
+        settings = memory_settings()
+        boundary = self.db.execute(
+            "SELECT time FROM Message ORDER BY time DESC LIMIT 1 OFFSET ?", (settings.compaction_keep,)
+        ).fetchone()
+        if boundary is None:
+            return []
+        after = self.summaries[-1].time if self.summaries else -1
+        limit = settings.episode_max_messages * (settings.compaction_batch + 1)
+        while True:
+            rows = self.db.rows("time > ? AND time <= ?", (after, boundary[0]), limit=limit)
+            episodes = group_episodes(
+                [self._row_to_record(row) for row in rows],
+                gap=settings.episode_gap,
+                max_messages=settings.episode_max_messages,
+                max_tokens=settings.episode_max_tokens,
+            )
+            # a window without a complete episode is widened, or compaction would stop there for good
+            if episodes or len(rows) < limit:
+                return episodes[: settings.compaction_batch]
+            limit *= 2
+
+    def add_summary(self, episode: List[Message], content: str, embeddings: bytes = b"", tokens: Optional[int] = None) -> Message:
+        """Store the summary of an episode, linked to its messages by their time range"""
+        start, end = episode[0].time, episode[-1].time
+        summary = Message(role=Role.ASSISTANT, name=SUMMARY_NAME, content=content,
+                          embeddings=embeddings, time=end, tokens=tokens)
+        self.db.insert_summary({
+            "time": end,
+            "start": start,
+            "end": end,
+            "content": content,
+            "embeddings": encode_embedding(embeddings, memory_settings().embedding_dtype),
+            "tokens": tokens,
+        })
+        self._add_summary_record(start, summary)
+        return summary
+
+    def _summary_rankings(self, msg: Message, n: int) -> List[List[Message]]:
+        """Summaries ranked by embedding and by BM25"""
+        rankings = [[self._summary_by_time[t] for t, _ in self.db.search_text(msg.content, n, table="Summary")
+                     if t in self._summary_by_time]]
+        if msg.embeddings:
+            rankings.insert(0, [self.summaries[i] for i in self.summary_index.top_k(msg.embeddings, n)])
+        return rankings
+
+    def _prefer_summaries(self, ranking: List[Message]) -> List[Message]:
+        """Replace compacted messages by their episode summary, each summary kept at its best rank"""
+        result, seen = [], set()
+        for m in ranking:
+            m = self.summary_of(m.time) or m
+            if m.time not in seen:
+                seen.add(m.time)
+                result.append(m)
+        return result
+
+    @staticmethod
+    def _row_to_message(row: dict) -> Message:
+        dtype = memory_settings().embedding_dtype
+        if dtype != "float32":
+            row["embeddings"] = encode_embedding(decode_embedding(row["embeddings"], dtype))
+        row["embeddings"] = row["embeddings"] or b""
+        return Message(**row)
+
+    @staticmethod
+    def _row_to_record(row: dict) -> MessageRecord:
+        dtype = memory_settings().embedding_dtype
+        if dtype != "float32":
+            row["embeddings"] = encode_embedding(decode_embedding(row["embeddings"], dtype))
+        row["embeddings"] = row["embeddings"] or b""
+        return MessageRecord(**row)
+
+    def _load_message(self, time: int) -> Optional[MessageRecord]:
+        """Read a message that is no longer in `messages` back from the db"""
+        row = self.db.get(time)
+        return self._row_to_record(row) if row else None
+
+    def older_messages(self, before: int, limit: int) -> List[MessageRecord]:
+        """Page in up to `limit` messages older than time `before` from the db, in time order"""
+        return [self._row_to_record(row) for row in self.db.tail(limit, before=before)]
+
+    def _sync_index(self) -> None:
+        """Keep embedding rows and the turn index aligned with `messages`, which agents may also edit directly"""
+        index, messages = self.index, self.messages
+        n = len(messages)
+        if index.size and (index.size > n or index.keys[0] != messages[0].time
+                           or index.keys[index.size - 1] != messages[index.size - 1].time):
+            index.clear()
+            self._by_time.clear()
+        if len(self.turns) != index.size:
+            self.turns = TurnIndex(messages[: index.size])
+        for m in messages[index.size:]:
+            index.append(m.time, m.embeddings)
+            self.turns.append(m)
+            self._by_time[m.time] = m
+
     def add_message(self, message: Message) -> None:
         """Add to db"""
-        if self.db:
-            self.db.add("Message", message, pk = "time")
+        self.db.insert(message.sqlite_repr)
+        if message.embeddings and not self.index.dim:
+            self.db.set_meta(dim=len(message.embeddings) // 4)
         """Add a message to memory"""
+        self._sync_index()
+        message = MessageRecord.of(message)
         self.messages.append(message)
+        self.index.append(message.time, message.embeddings)
+        self.turns.append(message)
+        self._by_time[message.time] = message
+        self._sidecar_append(message.time, message.embeddings)
+        if self.ann is not None:
+            self.ann.add(message.time, message.embeddings)
+            self.ann.maybe_rebuild()
         # Optional: Implement message limit
-        if len(self.messages) > self.max_messages:
-            self.messages = self.messages[-self.max_messages :]
+        self._trim()
 
     def add_messages(self, messages: List[Message]) -> None:
         """Add to db"""
-        if self.db:
-            for msg in messages:
-                self.db.add("Message", msg, pk = "time")
+        for msg in messages:
+            self.db.insert(msg.sqlite_repr)
         """Add multiple messages to memory"""
+        self._sync_index()
+        messages = [MessageRecord.of(msg) for msg in messages]
         self.messages.extend(messages)
+        for msg in messages:
+            self.index.append(msg.time, msg.embeddings)
+            self.turns.append(msg)
+            self._by_time[msg.time] = msg
+            self._sidecar_append(msg.time, msg.embeddings)
+            if self.ann is not None:
+                self.ann.add(msg.time, msg.embeddings)
+        if self.ann is not None:
+            self.ann.maybe_rebuild()
+        self._trim()
+
+    def missing_embeddings(self, limit: int) -> List[Tuple[int, str]]:
+        """(time, content) of the newest stored messages still waiting for their embedding"""
+        return self.db.unembedded(limit)
+
+    def set_embeddings(self, time: int, embeddings: bytes) -> None:
+        """Store the embedding of an already added message, as the background pipeline delivers it"""
+        if not embeddings:
+            return
+        self._sync_index()
+        if not self.index.dim:
+            self.db.set_meta(dim=len(embeddings) // 4)
+        message = self._by_time.get(time)
+        if message is not None:
+            message.embeddings = embeddings
+            for row in np.flatnonzero(self.index.keys[: self.index.size] == time):
+                self.index.set_row(row, embeddings)
+        self.db.update_embeddings(time, encode_embedding(embeddings, memory_settings().embedding_dtype))
+        self._sidecar_append(time, embeddings)
+        if self.ann is not None:
+            self.ann.add(time, embeddings)
+            self.ann.maybe_rebuild()
 
     def clear(self) -> None:
         """Clear all messages"""
         self.messages.clear()
+        self.index.clear()
+        self.turns = TurnIndex()
+        self._by_time.clear()
 
     @staticmethod
-    def _get_last_n_msgs(messages: List[Message], n: int):
-        r = []
-        c = 0
-        tool_call_ids = []
-        for m in messages[::-1]:
-            if m.role == Role.TOOL:
-                tool_call_ids.append(m.tool_call_id)
-                r.insert(0, m)
-                continue
-            skip = False
-            if m.tool_calls:
-                for f in m.tool_calls:
-                    if f.id in tool_call_ids:
-                        tool_call_ids.remove(f.id)
-                    else:
-                        skip = True
-            if skip:
-                continue
-            c += 1
-            if c >= n:
-                break
-            r.insert(0, m)
-        return r
+    def _get_last_n_msgs(messages: List[MessageRecord], n: int) -> MessageList:
+        return MessageList(as_message(m) for m in TurnIndex(messages).window(messages, n))
 
     @staticmethod
     def _gen_context_msg(m: Message):
+        if m.name == SUMMARY_NAME:
+            return Message(role=Role.USER, content=f"summary:{m.content}, until:{str(datetime.fromtimestamp(m.time/1000.0))}")
         return Message(role=Role.USER, content=f"releated:{m.content}, time:{str(datetime.fromtimestamp(m.time/1000.0))}")
 
 
-    def get_recent_messages(self, n: int) -> List[Message]:
+    def get_recent_messages(self, n: int) -> MessageList:
         """Get n most recent messages"""
-        all_messages = self.messages
-        # all_messages = sorted(all_messages, key=lambda m: m.time)
-        return Memory._get_last_n_msgs(all_messages, n)
+        self._sync_index()
+        if self.messages and len(self.turns.turns) < n - 1:
+            # the loaded window is too short, page in older messages
+            all_messages = self.older_messages(self.messages[0].time, n * 2) + self.messages
+            return Memory._get_last_n_msgs(all_messages, n)
+        return MessageList(as_message(m) for m in self.turns.window(self.messages, n))
+
+    def _messages_by_time(self, times) -> List[MessageRecord]:
+        mlist = [self._by_time.get(int(t)) or self._load_message(int(t)) for t in times]
+        return [m for m in mlist if m]
+
+    def _vector_related(self, msg: Message, n: int) -> List[Message]:
+        """Top n messages by cosine similarity, one matrix-vector product over the whole history.
+
+        With a quantized index `rerank_factor * n` candidates are fetched and
+        re-ranked by the exact similarity of their stored embeddings.
+        """
+        self._sync_index()
+        settings = memory_settings()
+        rerank = settings.index_dtype != "float32" and settings.rerank_factor > 1
+        k = n * settings.rerank_factor if rerank else n
+        if self.ann and len(self.ann) >= self.ann.min_size:
+            mlist = self._messages_by_time(self.ann.search(msg.embeddings, k)[0])
+        elif self.sidecar is None:
+            mlist = [self.messages[i] for i in self.index.top_k(msg.embeddings, k)]
+        else:
+            if self.sidecar.readonly:
+                self.sidecar.refresh()
+            mlist = self._messages_by_time(self.sidecar.search(msg.embeddings, k)[0])
+        if rerank:
+            scores = [embeddings_similarity(msg.embeddings, m.embeddings) for m in mlist]
+            mlist = [mlist[i] for i in np.argsort(-np.nan_to_num(scores), kind="stable")]
+        return mlist[:n]
+
+    def _lexical_related(self, msg: Message, n: int) -> List[Message]:
+        """Top n messages by BM25 over the full-text index, no embedding needed"""
+        return self._messages_by_time(t for t, _ in self.db.search_text(msg.content, n))
+
+    def _top_related(self, msg: Message, n: int) -> List[Message]:
+        """Top n related messages, vector and lexical rankings fused by reciprocal rank.
+
+        Exact tokens (names, paths, numbers) are found by the lexical side, and
+        a query whose embedding is pending or failed still gets lexical results.
+        Compacted messages are returned as their episode summary. The
+        candidates are then re-ranked by `_diversify`.
+        """
+        settings = memory_settings()
+        depth = max(n, settings.hybrid_candidates)
+        if not settings.hybrid_search and not self.summaries:
+            return self._diversify(msg, self._vector_related(msg, depth), n) if msg.embeddings else []
+        rankings = [self._lexical_related(msg, depth)] if settings.hybrid_search else []
+        if msg.embeddings:
+            rankings.insert(0, self._vector_related(msg, depth))
+        if self.summaries:
+            # a summary covers a whole episode, its messages are not worth a slot each;
+            # summaries never share a time with an uncompacted message
+            rankings = [self._prefer_summaries(r) for r in rankings] + self._summary_rankings(msg, depth)
+        by_time = {m.time: m for ranking in rankings for m in ranking}
+        fused = reciprocal_rank_fusion([[m.time for m in r] for r in rankings], k=settings.rrf_k)
+        return self._diversify(msg, [by_time[t] for t in fused[:depth]], n)
+
+    def _diversify(self, msg: Message, candidates: List[Message], n: int) -> List[Message]:
+        """Pick n of the ranked candidates by time-decayed relevance and maximal marginal relevance.
+
+        Relevance is the mean of the candidate's rank score (`rrf_k / (rrf_k + rank)`,
+        as flat as the fusion weights) and its cosine similarity to `msg`
+        (rank score alone without embeddings), scaled by
+        `1 - decay_weight + decay_weight * decay(age)`. MMR then penalizes
+        candidates similar to those already picked.
+        """
+        settings = memory_settings()
+        if len(candidates) <= 1 or (settings.decay_weight <= 0 and settings.mmr_lambda >= 1):
+            return candidates[:n]
+        k = len(candidates)
+        relevance = settings.rrf_k / (settings.rrf_k + np.arange(k))
+        query = as_vector(msg.embeddings)
+        dim = query.shape[0] if query is not None else self.index.dim
+        vectors = np.zeros((k, dim or 1), dtype=np.float32)
+        for i, m in enumerate(candidates):
+            vec = as_vector(m.embeddings)
+            if vec is not None and vec.shape[0] == vectors.shape[1]:
+                vectors[i] = vec
+        if query is not None:
+            norms = np.linalg.norm(vectors, axis=1) * np.linalg.norm(query)
+            cosine = np.divide(vectors @ query, norms, out=np.zeros(k, dtype=np.float32), where=norms > 0)
+            relevance = (relevance + cosine) / 2
+        now = msg.time or datetime.now().timestamp() * 1000
+        decay = time_decay([m.time for m in candidates], now, settings.decay_half_life * 86400_000)
+        relevance = relevance * (1 - settings.decay_weight + settings.decay_weight * decay)
+        return [candidates[i] for i in mmr(relevance, vectors, n, settings.mmr_lambda)]
 
     def get_related_messages(self, msg: Message, n: int = 1) -> List[Message]:
         """Get n most related messages"""
-        all_messages = self.messages
-        mlist = sorted(all_messages, key=lambda m: embeddings_similarity(m.embeddings, msg.embeddings), reverse=True)[:n]
+        mlist = self._top_related(msg, n)
         return [ Memory._gen_context_msg(m) for m in mlist]
 
-    def get_context_messages(self, msg: Message, n_recent: int, n_related: int = 1) -> List[Message]:
+    def get_context_messages(self, msg: Message, n_recent: int, n_related: int = 1) -> MessageList:
         """Get n most related messages"""
-        all_messages = self.messages
-        recent_list = Memory._get_last_n_msgs(all_messages, n_recent)
-        related_list = sorted(all_messages, key=lambda m: embeddings_similarity(m.embeddings, msg.embeddings), reverse=True)[:n_related] if msg else []
-        context_list = []
+        recent_list = self.get_recent_messages(n_recent)
+        related_list = self._top_related(msg, n_related) if msg else []
+        context_list = MessageList()
         for m in related_list:
             if not m in recent_list:
                 context_list.append(Memory._gen_context_msg(m))
         context_list.extend(recent_list)
         return context_list
 
+    def token_count(self, message: Message, llm) -> int:
+        """Tokens of a message, counted once with `llm.count_message` and stored with its row"""
+        if message.tokens is None:
+            message.tokens = llm.count_message(message)
+            if self._by_time.get(message.time) is message:
+                self.db.update_tokens(message.time, message.tokens)
+        return message.tokens
+
+    def _fit(self, message: Union[Message, MessageRecord], max_tokens: int, llm) -> Message:
+        """The message, or a copy with its content truncated to about `max_tokens`"""
+        tokens = self.token_count(message, llm)
+        message = as_message(message)
+        if tokens <= max_tokens or not message.content:
+            return message
+        overhead = tokens - llm.count_tokens(message.content)
+        content = llm.truncate_text(message.content, max_tokens - overhead)
+        return message.model_copy(update={"content": content, "tokens": None})
+
+    def get_budgeted_context(self, msg: Optional[Message], budget: int, llm) -> MessageList:
+        """Context messages packed into `budget` tokens (counted with `llm`).
+
+        Recent messages go first, newest back, into the budget minus the share
+        held for related messages. Related candidates then fill what is left,
+        best relevance per token first. Any message longer than
+        `context_item_share` of the budget is truncated.
+        """
+        self._sync_index()
+        settings = memory_settings()
+        max_item = max(int(budget * settings.context_item_share), 1)
+        recent_budget = budget - int(budget * settings.context_related_share)
+        recent: List[Message] = []
+        used = 0
+        for i, unit in enumerate(self.turns.units(self.messages)):
+            unit = [self._fit(m, max_item, llm) for m in unit]
+            cost = sum(self.token_count(m, llm) for m in unit)
+            if i == 0 and cost > budget:
+                # the newest turn always goes in, shrunk to the whole budget
+                unit = [self._fit(m, budget // len(unit), llm) for m in unit]
+                cost = sum(self.token_count(m, llm) for m in unit)
+            elif i and used + cost > recent_budget:
+                break
+            recent[:0] = unit
+            used += cost
+
+        recent = MessageList(recent)
+        related: List[Tuple[int, Message]] = []
+        if msg is not None and used < budget:
+            candidates = [m for m in self._top_related(msg, settings.hybrid_candidates) if m not in recent]
+            scored = []
+            for rank, m in enumerate(candidates):
+                context_msg = self._fit(Memory._gen_context_msg(m), max_item, llm)
+                tokens = self.token_count(context_msg, llm)
+                scored.append((1 / (rank + 1) / max(tokens, 1), rank, context_msg, tokens))
+            for _, rank, context_msg, tokens in sorted(scored, key=lambda s: s[0], reverse=True):
+                if used + tokens <= budget:
+                    related.append((rank, context_msg))
+                    used += tokens
+        return MessageList(m for _, m in sorted(related, key=lambda r: r[0])) + recent
+
     def to_dict_list(self) -> List[dict]:
         """Convert messages to list of dicts"""
         return [msg.to_dict() for msg in self.messages]
 
     def save(self):
-        if self.backend_db_file:
-            self.db.save(self.backend_db_file)
+        """Commit the pending batch, rows are already written as they are added"""
+        self.db.commit()
+        if self.sidecar is not None:
+            self.sidecar.flush()
+        if self.backend_db_file and self.ann is not None and not self._shared:
+            self.ann.save(self._ann_file)
 
     def close(self):
+        if self.closed:
+            return
         self.save()
+        self.db.close()
+        if self.sidecar is not None:
+            if not self._shared and self.sidecar.deleted > 0.2 * len(self.sidecar):
+                self.sidecar.compact()
+            self.sidecar.close()
+        self.closed = True
+
+
+class MemoryShards:
+    """Session-scoped memories, one db file (with its sidecar files) per conversation.
+
+    At most `max_open` shards are open at a time. Opening another closes the
+    least recently used one, which releases its db handle, embedding map and
+    hot messages; it is reopened from its files when its session comes back.
+    """
+
+    def __init__(self, directory: str = "", max_open: int = 0):
+        settings = memory_settings()
+        self.directory = directory or settings.session_dir
+        self._open = LRUCache(max_open or settings.max_open_sessions, on_evict=self._evict)
+
+    def __len__(self) -> int:
+        return len(self._open)
+
+    def __contains__(self, session: str) -> bool:
+        return session in self._open
+
+    def open_memories(self) -> List[Memory]:
+        return self._open.values()
+
+    def file(self, session: str) -> str:
+        """db file of a session, ids that are not plain file names get a hash suffix"""
+        name = re.sub(r"[^\w.-]", "_", session)[:64]
+        if name != session:
+            name += "-" + hashlib.sha1(session.encode()).hexdigest()[:8]
+        return path.join(self.directory, f"{name}.db")
+
+    def get(self, session: str) -> Memory:
+        """Memory of a session, opened (or reopened) on demand"""
+        memory = self._open.get(session)
+        if memory is None or memory.closed:
+            memory = Memory(backend_db_file=self.file(session))
+            self._open.put(session, memory)
+        return memory
+
+    def set_embeddings(self, session: str, time: int, embeddings: bytes) -> None:
+        """Store a background embedding without touching the LRU: an open shard
+        takes it directly, a closed one is opened just for the write, so a late
+        result never evicts a shard that is in use."""
+        memory = self._open.peek(session)
+        if memory is not None and not memory.closed:
+            memory.set_embeddings(time, embeddings)
+            return
+        memory = Memory(backend_db_file=self.file(session))
+        try:
+            memory.set_embeddings(time, embeddings)
+        finally:
+            memory.close()
+
+    @staticmethod
+    def _evict(session: str, memory: Memory) -> None:
+        logger.debug(f"Closing memory of session {session}")
+        memory.close()
+
+    def close(self, session: Optional[str] = None) -> None:
+        """Close one session, or all of them"""
+        memories = [self._open.pop(session)] if session is not None else self._open.values()
+        if session is None:
+            self._open.clear()
+        for memory in memories:
+            if memory is not None:
+                memory.close()
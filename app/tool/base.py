@@ -11,6 +11,9 @@ class BaseTool(ABC, BaseModel):
     description: str
     parameters: Optional[dict] = None
     wait: bool = True
+    # no side effects, so the call may start while the response is still
+    # streaming and be thrown away if that response is not used
+    idempotent: bool = False
     call_back: Optional[Callable] = None
     agent: Optional[BaseAgent] = None
 
@@ -25,6 +25,11 @@ class ToolCollection:
             tool.set_agent(agent=agent)
 
 
+    def idempotent(self, name: str) -> bool:
+        """Whether calls of tool `name` may start early: side-effect free and without a memory call_back"""
+        tool = self.tool_map.get(name)
+        return bool(tool and tool.idempotent and tool.wait)
+
     def to_params(self) -> List[Dict[str, Any]]:
         return [tool.to_param() for tool in self.tools]
 
@@ -17,6 +17,7 @@ from app.tool.search import (
 
 class WebSearch(BaseTool):
     name: str = "web_search"
+    idempotent: bool = True
     description: str = """Perform a web search and return a list of relevant links.
     This function attempts to use the primary search engine API to get up-to-date results.
     If an error occurs, it falls back to an alternative search engine."""
@@ -30,6 +30,10 @@ async def main():
             elif may_internal_cmd == "llmreload":
                 agent.llm.reload()
                 continue
+            elif may_internal_cmd.split()[:1] == ["session"]:
+                # "session <id>" switches to that conversation's memory, "session" back to the default one
+                agent.use_session(prompt.split(maxsplit=1)[1] if " " in prompt.strip() else None)
+                continue
             # logger.warning("Processing your request...")
             if prompt:
                 result = await agent.run(prompt)
@@ -39,6 +43,7 @@ async def main():
             logger.error(e)
             traceback.print_exc()
     await AsyncTimer.close()
+    await agent.flush_memory()
     agent.close()
 
 
@@ -39,6 +39,7 @@ async def main():
             # logger.warning("Processing your request...")
         elif may_internal_cmd == "/exit":
             await AsyncTimer.close()
+            await agent.flush_memory()
             agent.close()
             os.kill(os.getpid(), signal.SIGTERM)
         elif prompt:
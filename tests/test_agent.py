@@ -0,0 +1,96 @@
+import asyncio
+
+from app.agent.base import BaseAgent
+from app.agent.toolcall import ToolCallAgent
+from app.memory import EmbeddingPipeline
+from app.schema import Function, Memory, Message, ToolCall
+from app.tool.base import BaseTool
+from app.tool.tool_collection import ToolCollection
+
+
+class EchoAgent(BaseAgent):
+    async def step(self) -> str:
+        return ""
+
+
+def test_missing_embeddings_are_backfilled(tmp_path):
+    file = str(tmp_path / "nahida.db")
+    failing = True
+
+    async def embed(content: str) -> bytes:
+        if failing:
+            raise ConnectionError("embedding endpoint down")
+        return bytes(16)
+
+    # the embedding fails for good in the first run
+    agent = EchoAgent(name="echo", memory=Memory(backend_db_file=file))
+    agent._embedder = EmbeddingPipeline(embed, agent._store_embedding, retries=0)
+
+    async def first_run():
+        await agent.update_memory_message(Message.user_message("remember this"))
+        await agent._embedder.flush(1)
+
+    asyncio.run(first_run())
+    assert agent.memory.missing_embeddings(10)
+
+    # the next flush tries it again
+    failing = False
+    assert asyncio.run(agent.flush_memory(1))
+    assert agent.memory.missing_embeddings(10) == []
+    agent.memory.close()
+
+
+def test_backfill_on_first_write_after_restart(tmp_path):
+    file = str(tmp_path / "nahida.db")
+    memory = Memory(backend_db_file=file)
+    memory.add_message(Message(role="user", content="queued at shutdown", time=1))
+    memory.close()
+
+    async def embed(content: str) -> bytes:
+        return bytes(16)
+
+    agent = EchoAgent(name="echo", memory=Memory(backend_db_file=file))
+    agent._embedder = EmbeddingPipeline(embed, agent._store_embedding)
+
+    async def run():
+        await agent.update_memory_message(Message.user_message("hello again"))
+        await agent._embedder.flush(1)
+
+    asyncio.run(run())
+    assert agent.memory.missing_embeddings(10) == []
+    agent.memory.close()
+
+
+class Lookup(BaseTool):
+    name: str = "lookup"
+    description: str = "answers at once"
+
+    async def execute(self) -> str:
+        return "looked up"
+
+
+class Background(BaseTool):
+    name: str = "background"
+    description: str = "reports through its call_back"
+    wait: bool = False
+
+    async def execute(self) -> str:
+        await self.call_back("reported in the background")
+        return "started"
+
+
+def test_tool_results_keep_call_order():
+    agent = ToolCallAgent(name="tools", available_tools=ToolCollection(Lookup(), Background()))
+    agent.available_tools.set_agent(agent)
+    agent._embedder = EmbeddingPipeline(lambda content: asyncio.sleep(0, bytes(16)), agent._store_embedding)
+    agent.tool_calls = [
+        ToolCall(id=f"call-{name}", function=Function(name=name, arguments="{}"))
+        for name in ("lookup", "background")
+    ]
+
+    asyncio.run(agent.act())
+    contents = [m.content for m in agent.memory.messages if m.role == "tool"]
+    assert len(contents) == 3
+    assert "looked up" in contents[0]
+    assert contents[1] == "reported in the background"
+    assert "started" in contents[2]
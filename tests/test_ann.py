@@ -0,0 +1,53 @@
+import os
+
+import numpy as np
+import pytest
+
+import app.schema
+from app.config import MemorySettings
+from app.schema import Memory, Message
+
+
+@pytest.fixture
+def ann_enabled(monkeypatch):
+    settings = MemorySettings(ann_enabled=True)
+    monkeypatch.setattr(app.schema, "memory_settings", lambda: settings)
+
+
+def embedded_message(time: int) -> Message:
+    vector = np.random.default_rng(time).standard_normal(8).astype(np.float32)
+    return Message(role="user", content=f"message {time}", time=time, embeddings=vector.tobytes())
+
+
+def test_fresh_memory_feeds_ann(tmp_path, ann_enabled):
+    memory = Memory(backend_db_file=str(tmp_path / "nahida.db"))
+    assert memory.ann is not None and len(memory.ann) == 0
+    memory.add_message(embedded_message(1))
+    memory.add_messages([embedded_message(2), embedded_message(3)])
+    assert len(memory.ann) == 3
+    memory.close()
+
+    reopened = Memory(backend_db_file=str(tmp_path / "nahida.db"))
+    assert len(reopened.ann) == 3
+    reopened.close()
+
+
+def test_unchanged_ann_is_not_rewritten(tmp_path, ann_enabled):
+    file = str(tmp_path / "nahida.db")
+    memory = Memory(backend_db_file=file)
+    memory.add_message(embedded_message(1))
+    memory.close()
+    saved = os.stat(memory._ann_file).st_mtime_ns
+
+    reopened = Memory(backend_db_file=file)
+    assert not reopened.ann.dirty
+    reopened.close()
+    assert os.stat(memory._ann_file).st_mtime_ns == saved
+
+    reopened = Memory(backend_db_file=file)
+    reopened.add_message(embedded_message(2))
+    assert reopened.ann.dirty
+    reopened.close()
+    reopened = Memory(backend_db_file=file)
+    assert reopened.ann.max_id == 2
+    reopened.close()
@@ -0,0 +1,49 @@
+from types import SimpleNamespace
+
+import pytest
+
+import app.schema
+from app.config import MemorySettings
+from app.memory import group_episodes
+from app.schema import Function, Memory, Message, ToolCall
+
+
+def record(time: int, role: str, tool_calls=None) -> SimpleNamespace:
+    return SimpleNamespace(time=time, role=role, content="x", tool_calls=tool_calls, tokens=10)
+
+
+def test_episode_without_user_message_is_cut_outside_tool_chains():
+    # a long tool chain: assistant call, tool result, assistant call, ...
+    messages = [record(0, "user")]
+    for time in range(1, 40, 2):
+        messages.append(record(time, "assistant", tool_calls=["call"]))
+        messages.append(record(time + 1, "tool"))
+    messages.append(record(41, "user"))
+
+    episodes = group_episodes(messages, max_messages=5, max_tokens=10000)
+    assert len(episodes) > 1
+    assert sum(map(len, episodes)) == 41
+    for episode in episodes:
+        assert episode[0].role != "tool" and episode[-1].role != "assistant"
+        assert len(episode) <= 11
+
+
+@pytest.fixture
+def small_episodes(monkeypatch):
+    settings = MemorySettings(compaction_keep=2, compaction_batch=2, episode_max_messages=4)
+    monkeypatch.setattr(app.schema, "memory_settings", lambda: settings)
+
+
+def test_compaction_moves_past_run_without_user_messages(tmp_path, small_episodes):
+    memory = Memory(backend_db_file=str(tmp_path / "nahida.db"))
+    memory.add_message(Message(role="user", content="check on me", time=1))
+    call = ToolCall(id="call", function=Function(name="web_search", arguments="{}"))
+    for time in range(2, 40, 2):
+        memory.add_message(Message(role="assistant", content="", tool_calls=[call], time=time))
+        memory.add_message(Message(role="tool", content="result", tool_call_id="call", time=time + 1))
+
+    episodes = memory.episodes_to_compact()
+    assert episodes
+    memory.add_summary(episodes[-1], "summary")
+    assert memory.episodes_to_compact()[0][0].time > episodes[-1][-1].time
+    memory.close()
@@ -0,0 +1,217 @@
+import asyncio
+import itertools
+from types import SimpleNamespace
+
+import httpx
+from openai import BadRequestError
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+
+from app.cache import ResponseCache
+from app.config import LLMSettings
+from app.llm import LLM
+from app.memory import decode_embedding
+from app.schema import Message
+
+
+_names = itertools.count()
+
+
+def make_llm(**settings) -> LLM:
+    """A fresh LLM instance under a config name no other test uses"""
+    name = f"test-{next(_names)}"
+    llm_config = LLMSettings(
+        model="text-embedding-3-small",
+        base_url="http://localhost",
+        api_key="test",
+        api_type="",
+        api_version="",
+        embedding_cache=False,
+        **settings,
+    )
+    return LLM(name, {"default": llm_config})
+
+
+def bad_request() -> BadRequestError:
+    response = httpx.Response(400, request=httpx.Request("POST", "http://localhost"))
+    return BadRequestError("input too long", response=response, body=None)
+
+
+class FakeEmbeddings:
+    """Embeds every input as [len(input)], rejects any request containing `bad`"""
+
+    def __init__(self, bad=None):
+        self.bad = bad
+        self.calls = []
+
+    async def create(self, model, input, **kwargs):
+        self.calls.append(list(input))
+        if self.bad in input:
+            raise bad_request()
+        data = [SimpleNamespace(index=i, embedding=[float(len(c))]) for i, c in enumerate(input)]
+        return SimpleNamespace(data=data)
+
+
+def test_failed_batch_only_fails_bad_input():
+    llm = make_llm(embedding_batch_window=0.01)
+    llm.client = SimpleNamespace(embeddings=FakeEmbeddings(bad="bad"))
+
+    async def run():
+        return await asyncio.gather(
+            *(llm.get_embedding(c) for c in ["a", "bb", "bad", "cccc"]), return_exceptions=True
+        )
+
+    results = asyncio.run(run())
+    assert isinstance(results[2], BadRequestError)
+    assert [decode_embedding(r)[0] for r in (results[0], results[1], results[3])] == [1, 2, 4]
+
+
+def test_embedding_input_truncated_to_model_limit():
+    llm = make_llm(embedding_batch_size=1, embedding_max_tokens=16)
+    fake = FakeEmbeddings()
+    llm.client = SimpleNamespace(embeddings=fake)
+    asyncio.run(llm.get_embedding("word " * 100))
+    assert llm.count_tokens(fake.calls[0][0]) <= 16
+
+
+def tool_call_chunk(index, call_id=None, name=None, arguments=""):
+    function = {"arguments": arguments}
+    if name:
+        function["name"] = name
+    return ChatCompletionChunk.model_validate(
+        {
+            "id": "chunk",
+            "object": "chat.completion.chunk",
+            "created": 0,
+            "model": "test",
+            "choices": [
+                {
+                    "index": 0,
+                    "finish_reason": None,
+                    "delta": {"tool_calls": [{"index": index, "id": call_id, "type": "function", "function": function}]},
+                }
+            ],
+        }
+    )
+
+
+class BrokenStream:
+    """Streams one complete tool call, then the connection drops"""
+
+    def __aiter__(self):
+        return self._chunks()
+
+    async def _chunks(self):
+        yield tool_call_chunk(0, "call-1", "web_search", '{"query": "nahida"}')
+        raise ConnectionError("stream dropped")
+
+
+def test_failed_stream_cancels_dispatched_calls():
+    llm = make_llm()
+
+    async def create(**kwargs):
+        return BrokenStream()
+
+    llm.client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+    async def run():
+        tasks = []
+
+        def dispatch(call):
+            tasks.append(asyncio.ensure_future(asyncio.sleep(10)))
+            return tasks[-1]
+
+        try:
+            await llm._stream_tool_response({"model": "test", "messages": []}, 0, lambda text: None, dispatch)
+        except ConnectionError:
+            pass
+        await asyncio.sleep(0)
+        return tasks
+
+    tasks = asyncio.run(run())
+    assert len(tasks) == 1 and tasks[0].cancelled()
+
+
+def test_single_flight_shares_and_survives_cancellation():
+    llm = make_llm()
+    sent = []
+
+    async def send():
+        sent.append(1)
+        await asyncio.sleep(0.05)
+        return len(sent)
+
+    async def run():
+        first = asyncio.ensure_future(llm._single_flight("key", send))
+        second = asyncio.ensure_future(llm._single_flight("key", send))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        return await second
+
+    assert asyncio.run(run()) == (1, True)
+    assert sent == [1]
+
+
+def test_single_flight_new_caller_after_last_cancel():
+    llm = make_llm()
+
+    async def send():
+        await asyncio.sleep(0.05)
+        return "done"
+
+    async def run():
+        waiter = asyncio.ensure_future(llm._single_flight("key", send))
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        await asyncio.sleep(0)
+        # same key before the cancelled request's done-callback has run
+        return await llm._single_flight("key", send)
+
+    assert asyncio.run(run()) == ("done", False)
+
+
+def test_response_cache_key_ignores_transport_params(tmp_path):
+    llm = make_llm(temperature=0)
+    llm._response_cache = ResponseCache("test", file=str(tmp_path / "cache.db"))
+    calls = []
+
+    async def create(**kwargs):
+        calls.append(kwargs)
+        return ChatCompletion.model_validate(
+            {
+                "id": "completion",
+                "object": "chat.completion",
+                "created": 0,
+                "model": "test",
+                "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "hi"}}],
+                "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+            }
+        )
+
+    llm.client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+    async def run():
+        for user, timeout in (("alice", 10), ("bob", 30)):
+            message = await llm.ask_tool([Message.user_message("hello")], stream=False, timeout=timeout, user=user)
+            assert message.content == "hi"
+
+    asyncio.run(run())
+    assert len(calls) == 1
+    assert llm.response_cache.stats()["hits"] == 1
+
+
+def test_embedding_batch_pending_across_event_loops():
+    llm = make_llm(embedding_batch_window=0.5)
+    fake = FakeEmbeddings()
+    llm.client = SimpleNamespace(embeddings=fake)
+
+    async def leave_pending():
+        asyncio.ensure_future(llm.get_embedding("a"))
+        await asyncio.sleep(0.01)
+
+    async def embed():
+        return await asyncio.wait_for(llm.get_embedding("bb"), 2)
+
+    # the first loop ends inside the batch window
+    asyncio.run(leave_pending())
+    assert decode_embedding(asyncio.run(embed()))[0] == 2
+    assert fake.calls == [["bb"]]
@@ -0,0 +1,42 @@
+import asyncio
+
+from app.memory import EmbeddingPipeline
+
+
+async def _embed(content: str) -> bytes:
+    await asyncio.sleep(0.01)
+    return content.encode()
+
+
+def test_pipeline_survives_new_event_loops():
+    results = {}
+    pipeline = EmbeddingPipeline(_embed, results.__setitem__)
+
+    async def submit(key, flush=True):
+        await pipeline.submit(key, f"message {key}")
+        if flush:
+            assert await pipeline.flush(2)
+
+    # one asyncio.run per GUI rerun
+    asyncio.run(submit(1))
+    asyncio.run(submit(2))
+    assert results == {1: b"message 1", 2: b"message 2"}
+
+    # work left queued when a loop ends is done by the next one
+    asyncio.run(submit(3, flush=False))
+    assert asyncio.run(pipeline.flush(2))
+    assert results[3] == b"message 3"
+
+
+def test_flush_is_bounded():
+    async def hang(content: str) -> bytes:
+        await asyncio.sleep(60)
+
+    async def run():
+        pipeline = EmbeddingPipeline(hang, lambda key, value: None)
+        await pipeline.submit(1, "stuck")
+        flushed = await pipeline.flush(0.05)
+        await pipeline.close(0)
+        return flushed
+
+    assert asyncio.run(run()) is False
@@ -0,0 +1,21 @@
+import asyncio
+
+from app.rate_limit import RateLimiter
+
+
+def test_limiter_survives_new_event_loops():
+    limiter = RateLimiter(max_in_flight=1)
+
+    async def request():
+        await limiter.acquire()
+        try:
+            await asyncio.sleep(0.01)
+        finally:
+            limiter.release()
+
+    async def contend():
+        await asyncio.gather(request(), request())
+
+    # one asyncio.run per GUI rerun, each with concurrent requests
+    asyncio.run(contend())
+    asyncio.run(contend())
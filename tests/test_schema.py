@@ -0,0 +1,42 @@
+import copy
+import pickle
+
+from app.schema import Message, MessageList
+
+
+def make_list() -> MessageList:
+    return MessageList(
+        [
+            Message(role="user", content="hi", time=1),
+            Message(role="assistant", content="hello", time=2),
+            Message.user_message("unsaved"),
+        ]
+    )
+
+
+def assert_same(result, messages: MessageList) -> None:
+    assert isinstance(result, MessageList)
+    assert [m.content for m in result] == [m.content for m in messages]
+    # the copy keeps de-duplicating by time
+    result.append(Message(role="user", content="again", time=1))
+    assert len(result) == len(messages)
+    assert Message(role="user", content="x", time=2) in result
+
+
+def test_copy():
+    messages = make_list()
+    assert_same(copy.copy(messages), messages)
+    assert_same(messages.copy(), messages)
+
+
+def test_deepcopy():
+    messages = make_list()
+    result = copy.deepcopy(messages)
+    assert_same(result, messages)
+    assert result[0] is not messages[0]
+
+
+def test_pickle():
+    messages = make_list()
+    for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+        assert_same(pickle.loads(pickle.dumps(messages, protocol)), messages)
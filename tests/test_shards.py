@@ -0,0 +1,24 @@
+import numpy as np
+
+from app.schema import MemoryShards, Message
+
+
+def test_late_embedding_does_not_evict_active_shard(tmp_path):
+    shards = MemoryShards(str(tmp_path), max_open=1)
+    old = shards.get("old")
+    old.add_message(Message(role="user", content="from the old session", time=1))
+    active = shards.get("active")
+    assert old.closed and not active.closed
+
+    # a background embedding for the evicted session arrives late
+    vector = np.arange(1, 5, dtype=np.float32).tobytes()
+    shards.set_embeddings("old", 1, vector)
+
+    assert not active.closed
+    assert shards.get("active") is active
+    active.add_message(Message(role="user", content="still writable", time=2))
+
+    reopened = shards.get("old")
+    assert reopened.messages[-1].embeddings == vector
+    assert reopened.sidecar.search(vector, 1)[0].tolist() == [1]
+    shards.close()
@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+
+from app.memory import EmbeddingSidecar, SidecarLocked
+from app.memory.sidecar import fcntl
+from app.schema import Memory, Message
+
+
+def vector(value: float) -> np.ndarray:
+    return np.full(4, value, dtype=np.float32)
+
+
+def test_late_reappend_replaces_row(tmp_path):
+    sidecar = EmbeddingSidecar(str(tmp_path / "m.emb"))
+    for key in (1, 2, 3):
+        sidecar.append(key, vector(key))
+    # a late embedding for an older message
+    sidecar.append(2, vector(-1))
+    assert sidecar.deleted == 1
+    keys, vectors = sidecar.newer_than(0)
+    assert sorted(keys.tolist()) == [1, 2, 3]
+    assert vectors[keys.tolist().index(2)][0] == -1
+    sidecar.close()
+
+    reopened = EmbeddingSidecar(str(tmp_path / "m.emb"))
+    reopened.append(2, vector(5))
+    assert reopened.deleted == 2
+    assert reopened.compact() == 2
+    reopened.append(3, vector(6))
+    assert sorted(reopened.newer_than(0)[0].tolist()) == [1, 2, 3]
+    reopened.close()
+
+
+def test_in_order_appends_do_not_index_rows(tmp_path):
+    sidecar = EmbeddingSidecar(str(tmp_path / "m.emb"))
+    for key in (1, 2, 3):
+        sidecar.append(key, vector(key))
+    sidecar.close()
+    reopened = EmbeddingSidecar(str(tmp_path / "m.emb"))
+    reopened.append(4, vector(4))
+    assert reopened._rows is None
+    # out of order: the key may have a row already
+    reopened.append(0, vector(1))
+    assert reopened._rows is not None and reopened.deleted == 0
+    reopened.close()
+
+
+def test_search_skips_tombstones(tmp_path):
+    sidecar = EmbeddingSidecar(str(tmp_path / "m.emb"))
+    for key in (1, 2, 3):
+        sidecar.append(key, vector(key))
+    sidecar.append(2, vector(-1))
+    keys, scores = sidecar.search(vector(1), 10)
+    assert sorted(keys.tolist()) == [1, 2, 3]
+    assert np.isfinite(scores).all()
+    sidecar.close()
+
+
+@pytest.mark.skipif(fcntl is None, reason="no advisory locks on this platform")
+def test_single_writer(tmp_path):
+    file = str(tmp_path / "m.emb")
+    writer = EmbeddingSidecar(file)
+    writer.append(1, vector(1))
+    writer.flush()
+    with pytest.raises(SidecarLocked):
+        EmbeddingSidecar(file)
+    reader = EmbeddingSidecar(file, readonly=True)
+    assert reader.newer_than(0)[0].tolist() == [1]
+    writer.close()
+    EmbeddingSidecar(file).close()
+
+
+@pytest.mark.skipif(fcntl is None, reason="no advisory locks on this platform")
+def test_second_memory_on_same_db_is_read_only(tmp_path):
+    file = str(tmp_path / "nahida.db")
+    first = Memory(backend_db_file=file)
+    second = Memory(backend_db_file=file)
+    assert not first.sidecar.readonly and second.sidecar.readonly
+    second.add_message(Message(role="user", content="from the second process", time=1,
+                               embeddings=vector(1).tobytes()))
+    second.close()
+    first.close()
+    reopened = Memory(backend_db_file=file)
+    # the row only the db had is caught up by the owner
+    assert len(reopened.sidecar) == 1
+    reopened.close()
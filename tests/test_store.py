@@ -0,0 +1,73 @@
+import sqlite3
+
+from app.memory import MessageStore
+from app.memory.store import segment_cjk
+
+
+MESSAGES = {
+    1: "我们明天去北京的故宫博物院",
+    2: "上海的天气怎么样",
+    3: "remember the meeting in Tokyo",
+}
+
+
+def make_store(file: str = "") -> MessageStore:
+    store = MessageStore(file)
+    for time, content in MESSAGES.items():
+        store.insert({"role": "user", "time": time, "content": content})
+    store.commit()
+    return store
+
+
+def matches(store: MessageStore, text: str) -> list:
+    return [time for time, _ in store.search_text(text, 10)]
+
+
+def test_segment_cjk_bigrams():
+    assert segment_cjk("去北京") == " 去北 北京 "
+    assert segment_cjk("a北b") == "a 北 b"
+
+
+def test_search_cjk():
+    store = make_store()
+    if not store.fts:
+        return
+    assert matches(store, "北京") == [1]
+    assert matches(store, "故宫") == [1]
+    assert matches(store, "上海天气") == [2]
+    assert matches(store, "去北京玩吗")[0] == 1
+    assert matches(store, "meeting") == [3]
+    assert matches(store, "广州") == []
+
+
+def test_search_cjk_after_update_and_delete():
+    store = make_store()
+    if not store.fts:
+        return
+    store.insert({"role": "user", "time": 1, "content": "去广州"})
+    assert matches(store, "北京") == []
+    assert matches(store, "广州") == [1]
+    store.execute("DELETE FROM Message WHERE time = 2")
+    assert matches(store, "上海") == []
+
+
+def test_reindex_unsegmented_fts(tmp_path):
+    file = str(tmp_path / "old.db")
+    make_store(file).close()
+    # index as it was built before CJK segmentation
+    conn = sqlite3.connect(file)
+    conn.execute("DROP TRIGGER Message_fts_insert")
+    conn.execute("DROP TABLE MessageFTS")
+    conn.execute("CREATE VIRTUAL TABLE MessageFTS USING fts5(content, content='Message', content_rowid='time')")
+    conn.execute("INSERT INTO MessageFTS (MessageFTS) VALUES ('rebuild')")
+    conn.execute(
+        "CREATE TRIGGER Message_fts_insert AFTER INSERT ON Message BEGIN "
+        "INSERT INTO MessageFTS (rowid, content) VALUES (new.time, new.content); END"
+    )
+    conn.commit()
+    conn.close()
+
+    store = MessageStore(file)
+    if store.fts:
+        assert matches(store, "故宫") == [1]
+    store.close()